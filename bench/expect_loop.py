@@ -0,0 +1,44 @@
+"""Push a large amount of output through spawn.expect_list and report how long
+it took and the peak RSS of this process.
+
+Run from the package root, outside of Sublime Text:
+
+    python bench/expect_loop.py [megabytes] [select|poll]
+
+The child is a stand-in REPL: a python one-liner that prints the requested
+amount of output in 100 character lines followed by a '>>> ' prompt.
+"""
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from repl import pexpect
+
+CHILD = ("import sys; line = 'x' * 99 + '\\n'; "
+         "[sys.stdout.write(line) for i in range(%d)]; "
+         "sys.stdout.write('>>> '); sys.stdout.flush(); sys.stdin.readline()")
+
+
+def main(megabytes, backend):
+    lines = megabytes * 1024 * 1024 // 100
+    child = pexpect.spawn(sys.executable, ['-c', CHILD % lines], timeout=60,
+                          backend=backend)
+    child.searchlookback = 256
+    prompt = child.compile_pattern_list([">>> ", "\\.\\.+ "])
+    start = time.time()
+    child.expect_list(prompt)
+    elapsed = time.time() - start
+    child.close()
+    # ru_maxrss is in kilobytes on Linux and bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    print("%d MB (%s): %.2fs, %d bytes received, peak RSS %.1f MB" % (
+        megabytes, child.backend, elapsed, len(child.before), peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+         sys.argv[2] if len(sys.argv) > 2 else 'select')
@@ -0,0 +1,65 @@
+"""Compare the regex and plain string prompt searchers on a large amount of
+output. Repl uses searcher_string when every prompt is a plain string.
+
+Run from the package root, outside of Sublime Text:
+
+    python bench/searchers.py [megabytes]
+
+The output is fed to each searcher the way spawn.expect_loop does: in
+maxread sized chunks, with the searcher seeing the fresh chunk plus its
+lookback. A '>>> ' prompt arrives at the very end.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from repl import pexpect
+
+PROMPTS = [">>> ", "node> ", "scala> "]
+LINE = "result[%d] -> {'name': 'node', 'value': 3.14} > 2\n"
+CHUNK = 2000
+
+
+def output(megabytes):
+    lines = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        lines.append(LINE % len(lines))
+        size += len(lines[-1])
+    return "".join(lines) + PROMPTS[0]
+
+
+def feed(searcher, data):
+    keep = getattr(searcher, 'lookback', None)
+    window = ""
+    for pos in range(0, len(data), CHUNK):
+        chunk = data[pos:pos + CHUNK]
+        if keep is None:
+            window = window + chunk
+        else:
+            window = window[-keep:] + chunk
+        index = searcher.search(window, len(chunk))
+        if index >= 0:
+            return index
+    return -1
+
+
+def main(megabytes):
+    data = output(megabytes)
+    regexes = [pexpect.EOF, pexpect.TIMEOUT] + [
+        re.compile(re.escape(p), re.DOTALL) for p in PROMPTS]
+    literals = [pexpect.EOF, pexpect.TIMEOUT] + PROMPTS
+    searchers = [
+        ("searcher_re", pexpect.searcher_re(regexes, 256)),
+        ("searcher_string", pexpect.searcher_string(literals)),
+    ]
+    for name, searcher in searchers:
+        start = time.time()
+        index = feed(searcher, data)
+        print("%-20s %7.3fs  index %d" % (name, time.time() - start, index))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,51 @@
+"""Compare how long a Python worksheet REPL takes to start and import some
+modules with the plain spawn start mode and with the zygote start mode.
+
+Run from the package root, outside of Sublime Text:
+
+    python bench/startup.py [runs] [module ...]
+
+Each run starts a REPL, imports the modules in it, and closes it. In zygote
+mode the modules are also given as zygote_modules, so the fork server has
+them imported already; starting the fork server itself is not timed.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import repl
+
+PYTHON = {
+    "cmd": sys.executable + " -i",
+    "prompt": [">>> ", "\\.\\.+ "],
+    "prefix": "# > ",
+    "error": ["Traceback "],
+    "send_pacing": "adaptive",
+    "zygote": '"%s" "{repl_base}/python/zygote.py"' % sys.executable,
+}
+
+
+def run(start_mode, modules):
+    repl_def = dict(PYTHON, start_mode=start_mode, zygote_modules=modules)
+    start = time.time()
+    python = repl.get_repl("Python", repl_def)
+    if modules:
+        python.correspond("import " + ", ".join(modules) + "\n")
+    elapsed = time.time() - start
+    python.close()
+    return elapsed
+
+
+def main(runs, modules):
+    run("zygote", modules)  # start the fork server
+    for start_mode in ("spawn", "zygote"):
+        times = sorted(run(start_mode, modules) for i in range(runs))
+        print("%-6s: median %.3fs, min %.3fs over %d runs" % (
+            start_mode, times[len(times) // 2], times[0], runs))
+    repl.close_zygotes()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+         sys.argv[2:] or ["decimal", "json", "asyncio"])
@@ -35,8 +35,20 @@ if not POSIX:
 
 
 from .repl import get_repl
+from .repl import get_async_repl
 from .repl import Repl
+from .repl import AsyncRepl
 from .repl import ReplResult
 from .repl import ReplStartError
-from .repl_thread import ReplThread
+from .repl import ReplStartCancelled
+from .repl import ReplCloseError
+from .repl import ReplPool
+from .repl import pool
+from .repl import close_zygotes
+from .repl import discard_checkpoint
+from .repl_thread import ReplJob
+from .repl_thread import ReplBatchJob
+from .repl_thread import ReplStartThread
+from .repl_thread import ReplWorker
+from .cache import ResultCache
 from . import ftfy
@@ -0,0 +1,121 @@
+import os
+import json
+
+from .repl import ReplResult
+
+
+def encode(record):
+    return (json.dumps(record) + "\n").encode("ascii")
+
+
+class ResultCache(object):
+    """Results of worksheet lines kept on disk, by a key that hashes all that
+    went into them (the worksheet's settings and its source up to the line).
+
+    The cache is a file of JSON lines that is only ever appended to:
+    [key, result] stores a result and [key] records that it was used, so
+    storing or using one is a single write. Loading replays the file. Once
+    it grows past max_size bytes, it is rewritten with the most recently
+    used results that fit in half of that.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        # key -> [size of its record, when it was last used, result]
+        self.entries = {}
+        self.clock = 0
+        self.size = 0
+        self.file = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    self.size += len(line)
+                    try:
+                        record = json.loads(line.decode("ascii"))
+                    except ValueError:
+                        # Cut short by a crash; the rest is still good.
+                        continue
+                    self.replay(record, len(line))
+        except (IOError, OSError):
+            pass
+
+    def replay(self, record, size):
+        self.clock += 1
+        if len(record) == 2:
+            self.entries[record[0]] = [size, self.clock, record[1]]
+        elif record[0] in self.entries:
+            self.entries[record[0]][1] = self.clock
+
+    def get(self, key):
+        """The ReplResult stored for key, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.clock += 1
+        entry[1] = self.clock
+        self.append([key])
+        return ReplResult.from_dict(entry[2])
+
+    def put(self, key, result):
+        values = result.to_dict()
+        if key in self.entries and self.entries[key][2] == values:
+            return self.get(key)
+        self.clock += 1
+        record = [key, values]
+        self.entries[key] = [len(encode(record)), self.clock, values]
+        self.append(record)
+
+    def append(self, record):
+        """Write record, compacting the file if that takes it past
+        max_size."""
+        line = encode(record)
+        try:
+            if self.file is None:
+                directory = os.path.dirname(self.path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.file = open(self.path, "ab")
+            self.file.write(line)
+        except (IOError, OSError) as e:
+            print("Worksheet: could not write the result cache %s: %s" % (self.path, e))
+        self.size += len(line)
+        if self.size > self.max_size:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the file with the most recently used results that fit in
+        half of max_size, forgetting the rest."""
+        self.close()
+        kept, size = {}, 0
+        recent = sorted(self.entries.items(), key=lambda item: item[1][1], reverse=True)
+        for key, entry in recent:
+            if size + entry[0] > self.max_size // 2:
+                break
+            kept[key] = entry
+            size += entry[0]
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                for key, entry in reversed(recent[:len(kept)]):
+                    f.write(encode([key, entry[2]]))
+            try:
+                os.rename(temp, self.path)
+            except OSError:
+                # Windows won't rename over a file.
+                os.remove(self.path)
+                os.rename(temp, self.path)
+        except (IOError, OSError) as e:
+            print("Worksheet: could not compact the result cache %s: %s" % (self.path, e))
+        self.entries, self.size = kept, size
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -84,6 +84,18 @@ try:
 except:
     pass
 
+try:
+    # Only aspawn needs these (Python 3.4+).
+    import asyncio
+    import codecs
+except ImportError:
+    asyncio = None
+
+try:
+    from re import _parser as sre_parse # Python 3.11 deprecates sre_parse.
+except ImportError:
+    import sre_parse
+
 try:
     import pty
     import tty
@@ -101,7 +113,7 @@ except:
 __version__ = '2.5.1'
 version = __version__
 version_info = (2,5,1)
-__all__ = ['ExceptionPexpect', 'EOF', 'TIMEOUT', 'spawn', 'spawnb', 'run', 'which',
+__all__ = ['ExceptionPexpect', 'EOF', 'TIMEOUT', 'spawn', 'spawnb', 'aspawn', 'fdspawn', 'run', 'which',
     'split_command_line', '__version__']
 
 PY3K = sys.version_info >= (3, 0, 0)
@@ -192,6 +204,44 @@ def _cast_unicode(s, enc):
 
 re_type = type(re.compile(''))
 
+def _pattern_width(pattern):
+
+    """This returns the maximum number of characters a compiled regular
+    expression can match, or None if the width is unbounded (or cannot be
+    worked out, e.g. on an old sre_parse). """
+
+    try:
+        width = sre_parse.parse(pattern.pattern, pattern.flags).getwidth()[1]
+    except Exception:
+        return None
+    if width >= sre_parse.MAXREPEAT:
+        return None
+    return width
+
+def _pattern_literal(pattern):
+
+    """If a compiled regular expression only ever matches one fixed string
+    this returns that string (of the pattern's type), otherwise None. """
+
+    if pattern.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    codes = []
+    for op, av in parsed:
+        if op != sre_parse.LITERAL:
+            return None
+        codes.append(av)
+    if not codes:
+        return None
+    if isinstance(pattern.pattern, binary_type):
+        return binary_type(bytearray(codes))
+    if PY3K:
+        return ''.join(chr(c) for c in codes)
+    return u('').join(unichr(c) for c in codes)
+
 def run (command, timeout=-1, withexitstatus=False, events=None, extra_args=None,
          logfile=None, cwd=None, env=None, encoding='utf-8'):
 
@@ -327,7 +377,7 @@ class spawnb(Iterator):
     encoding = 'utf-8'
 
     def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None,
-                 logfile=None, cwd=None, env=None):
+                 logfile=None, cwd=None, env=None, backend='select', preexec_fn=None):
 
         """This is the constructor. The command parameter may be a string that
         includes a command and any arguments to the command. For example::
@@ -369,6 +419,13 @@ class spawnb(Iterator):
         output are read back from the child. This feature is useful in
         conjunction with searchwindowsize.
 
+        expect() reads readsize bytes at a time. This starts out as maxread
+        and doubles, up to maxreadlimit, each time a read comes back full;
+        the first short read (the child is waiting again) drops it back to
+        maxread. maxreadlimit is maxread by default, which keeps the size
+        fixed. readcount and readbytes count the reads made and the bytes
+        they returned.
+
         The searchwindowsize attribute sets the how far back in the incomming
         seach buffer Pexpect will search for pattern matches. Every time
         Pexpect reads some data from the child it will append the data to the
@@ -379,6 +436,10 @@ class spawnb(Iterator):
         effect the size of the incomming data buffer. You will still have
         access to the full buffer after expect() returns.
 
+        If preexec_fn is given, it is called in the child after changing to
+        cwd and just before the command is executed, e.g. to set resource
+        limits. If it raises, the child exits with status 1.
+
         The logfile member turns on or off logging. All input and output will
         be copied to the given file object. Set logfile to None to stop
         logging. This is the default. Set logfile to sys.stdout to echo
@@ -424,6 +485,11 @@ class spawnb(Iterator):
         delaybeforesend to 0 to return to the old behavior. Most Linux machines
         don't like this to be below 0.03. I don't know why.
 
+        Set sendpacing to 'adaptive' to only sleep when it may be needed:
+        if the last expect() matched a pattern and nothing has been read
+        since, the child is sitting at its prompt and send() does not sleep.
+        The time skipped this way is added up in delaysaved.
+
         Note that spawn is clever about finding commands on your path.
         It uses the same logic that "which" uses to find executables.
 
@@ -435,7 +501,16 @@ class spawnb(Iterator):
         signalstatus will store the signal value and exitstatus will be None.
         If you need more detail you can also read the self.status member which
         stores the status returned by os.waitpid. You can interpret this using
-        os.WIFEXITED/os.WEXITSTATUS or os.WIFSIGNALED/os.TERMSIG. """
+        os.WIFEXITED/os.WEXITSTATUS or os.WIFSIGNALED/os.TERMSIG.
+
+        The backend parameter selects how read_nonblocking() waits for the
+        child. 'select' is the classic behaviour: isalive() is called before
+        every read and expect() sleeps briefly between reads. 'poll' waits on
+        select.poll() instead. Where os.pidfd_open() is available (Linux 5.3,
+        Python 3.9) the child's exit is registered with the same poll object,
+        so isalive() is never called in the read path. There is no sleep
+        between reads. OS X cannot poll() a pty, so 'poll' falls back to
+        'select' there. """
 
         try:
             self.STDIN_FILENO = pty.STDIN_FILENO
@@ -467,10 +542,18 @@ class spawnb(Iterator):
         self.logfile_read = None # input from child (read_nonblocking)
         self.logfile_send = None # output to send (send, sendline)
         self.maxread = maxread # max bytes to read at one time into buffer
+        self.maxreadlimit = maxread # readsize may grow up to this during bulk output
+        self.readsize = maxread # bytes expect() asks for in the next read
+        self.readcount = 0 # number of reads from the child
+        self.readbytes = 0 # total bytes those reads returned
         self.buffer = self._empty_buffer # This is the read buffer. See maxread.
         self.searchwindowsize = searchwindowsize # Anything before searchwindowsize point is preserved, but not searched.
+        self.searchlookback = None # Assumed maximum match width for regexes whose width is unbounded. None rescans the whole buffer.
         # Most Linux machines don't like delaybeforesend to be below 0.03 (30 ms).
         self.delaybeforesend = 0.05 # Sets sleep time used just before sending data to child. Time in seconds.
+        self.sendpacing = 'fixed' # 'fixed' always sleeps delaybeforesend, 'adaptive' skips it when the child is at a prompt.
+        self.delaysaved = 0.0 # Total delaybeforesend time skipped by adaptive pacing.
+        self._at_prompt = False # Set when the last expect() matched with nothing left over.
         self.delayafterclose = 0.1 # Sets delay in close() method to allow kernel time to update process status. Time in seconds.
         self.delayafterterminate = 0.1 # Sets delay in terminate() method to allow kernel time to update process status. Time in seconds.
         self.softspace = False # File-like object.
@@ -478,6 +561,12 @@ class spawnb(Iterator):
         self.closed = True # File-like object.
         self.cwd = cwd
         self.env = env
+        self.preexec_fn = preexec_fn
+        if backend == 'poll' and (not hasattr(select, 'poll') or sys.platform == 'darwin'):
+            backend = 'select'
+        self.backend = backend
+        self._poller = None
+        self._pidfd = None # Becomes readable when the child exits (poll backend).
         self.__irix_hack = (sys.platform.lower().find('irix')>=0) # This flags if we are running on irix
         # Solaris uses internal __fork_pty(). All others use pty.fork().
         if 'solaris' in sys.platform.lower() or 'sunos5' in sys.platform.lower():
@@ -539,11 +628,18 @@ class spawnb(Iterator):
         s.append('logfile_read: ' + str(self.logfile_read))
         s.append('logfile_send: ' + str(self.logfile_send))
         s.append('maxread: ' + str(self.maxread))
+        s.append('maxreadlimit: ' + str(self.maxreadlimit))
+        s.append('readsize: ' + str(self.readsize))
+        s.append('readcount: ' + str(self.readcount))
+        s.append('readbytes: ' + str(self.readbytes))
         s.append('ignorecase: ' + str(self.ignorecase))
         s.append('searchwindowsize: ' + str(self.searchwindowsize))
+        s.append('searchlookback: ' + str(self.searchlookback))
         s.append('delaybeforesend: ' + str(self.delaybeforesend))
+        s.append('sendpacing: ' + str(self.sendpacing))
         s.append('delayafterclose: ' + str(self.delayafterclose))
         s.append('delayafterterminate: ' + str(self.delayafterterminate))
+        s.append('backend: ' + str(self.backend))
         return '\n'.join(s)
 
     def _spawn(self,command,args=[]):
@@ -624,6 +720,13 @@ class spawnb(Iterator):
 
             if self.cwd is not None:
                 os.chdir(self.cwd)
+            if self.preexec_fn is not None:
+                try:
+                    self.preexec_fn()
+                except Exception as e:
+                    # Nobody is going to catch it in this process.
+                    sys.stderr.write('preexec_fn failed: %s\n' % e)
+                    os._exit(1)
             if self.env is None:
                 os.execv(self.command, self.args)
             else:
@@ -632,6 +735,21 @@ class spawnb(Iterator):
         # Parent
         self.terminated = False
         self.closed = False
+        self._register_child()
+
+    def _register_child(self):
+
+        """This sets up the poll backend for a newly started child. """
+
+        if self.backend == 'poll':
+            self._poller = select.poll()
+            self._poller.register(self.child_fd, select.POLLIN | select.POLLPRI)
+            if hasattr(os, 'pidfd_open'):
+                try:
+                    self._pidfd = os.pidfd_open(self.pid)
+                    self._poller.register(self._pidfd, select.POLLIN)
+                except OSError:
+                    self._pidfd = None
 
     def __fork_pty(self):
 
@@ -734,6 +852,10 @@ class spawnb(Iterator):
         if not self.closed:
             self.flush()
             os.close (self.child_fd)
+            if self._pidfd is not None:
+                os.close(self._pidfd)
+                self._pidfd = None
+            self._poller = None
             time.sleep(self.delayafterclose) # Give kernel time to update process status.
             if self.isalive():
                 if not self.terminate(force):
@@ -867,6 +989,9 @@ class spawnb(Iterator):
         if timeout == -1:
             timeout = self.timeout
 
+        if self._poller is not None:
+            return self.__read_poll(size, timeout)
+
         # Note that some systems such as Solaris do not give an EOF when
         # the child dies. In fact, you can still try to read
         # from the child_fd -- it will block forever or until TIMEOUT.
@@ -897,26 +1022,66 @@ class spawnb(Iterator):
                 raise TIMEOUT ('Timeout exceeded in read_nonblocking().')
 
         if self.child_fd in r:
-            try:
-                s = os.read(self.child_fd, size)
-            except OSError as e: # Linux does this
-                self.flag_eof = True
-                raise EOF ('End Of File (EOF) in read_nonblocking(). Exception style platform.')
-            if s == b'': # BSD style
-                self.flag_eof = True
-                raise EOF ('End Of File (EOF) in read_nonblocking(). Empty string style platform.')
+            return self.__read_child(size)
 
-            s2 = self._cast_buffer_type(s)
-            if self.logfile is not None:
-                self.logfile.write(s2)
-                self.logfile.flush()
-            if self.logfile_read is not None:
-                self.logfile_read.write(s2)
-                self.logfile_read.flush()
+        raise ExceptionPexpect ('Reached an unexpected state in read_nonblocking().')
 
-            return s
+    def __read_poll(self, size, timeout):
 
-        raise ExceptionPexpect ('Reached an unexpected state in read_nonblocking().')
+        """This is read_nonblocking() for the 'poll' backend. Readiness and
+        child exit both come from one poll() call, so there is no isalive()
+        per read. isalive() is only consulted on a timeout when there is no
+        pidfd to tell us about the child's exit. """
+
+        ready = dict(self.__poll(timeout))
+        if self.child_fd in ready:
+            # Includes POLLHUP/POLLERR: the read then reports the EOF.
+            return self.__read_child(size)
+        if self._pidfd is not None and self._pidfd in ready:
+            self.flag_eof = True
+            raise EOF ('End Of File (EOF) in read_nonblocking(). Child exited.')
+        if self._pidfd is None and not self.isalive():
+            self.flag_eof = True
+            raise EOF ('End of File (EOF) in read_nonblocking(). Very pokey platform.')
+        raise TIMEOUT ('Timeout exceeded in read_nonblocking().')
+
+    def __read_child(self, size):
+
+        """This reads at most size bytes from the child once it is known to
+        be readable, logging them if required. """
+
+        try:
+            s = os.read(self.child_fd, size)
+        except OSError as e: # Linux does this
+            self.flag_eof = True
+            raise EOF ('End Of File (EOF) in read_nonblocking(). Exception style platform.')
+        if s == b'': # BSD style
+            self.flag_eof = True
+            raise EOF ('End Of File (EOF) in read_nonblocking(). Empty string style platform.')
+        self._note_read(size, len(s))
+
+        s2 = self._cast_buffer_type(s)
+        if self.logfile is not None:
+            self.logfile.write(s2)
+            self.logfile.flush()
+        if self.logfile_read is not None:
+            self.logfile_read.write(s2)
+            self.logfile_read.flush()
+
+        return s
+
+    def _note_read(self, size, count):
+
+        """This counts a read of count bytes out of the size asked for, and
+        adapts readsize: doubled (up to maxreadlimit) after a full read, back
+        to maxread after a short one. """
+
+        self.readcount += 1
+        self.readbytes += count
+        if count < size:
+            self.readsize = self.maxread
+        elif self.readsize < self.maxreadlimit:
+            self.readsize = min(self.readsize * 2, self.maxreadlimit)
 
     def read (self, size = -1):         # File-like object.
         """This reads at most "size" bytes from the file (less if the read hits
@@ -1018,7 +1183,25 @@ class spawnb(Iterator):
         bytes written. If a log file was set then the data is also written to
         the log. """
 
-        time.sleep(self.delaybeforesend)
+        time.sleep(self._send_delay())
+        return self._write(s)
+
+    def _send_delay(self):
+
+        """This returns how long to wait before sending, according to
+        sendpacing, and keeps count of the time adaptive pacing saves. """
+
+        delay = self.delaybeforesend
+        if self.sendpacing == 'adaptive' and self._at_prompt:
+            self.delaysaved += delay
+            delay = 0
+        self._at_prompt = False
+        return delay
+
+    def _write(self, s):
+
+        """This writes a string to the child and the logs, without any
+        delay. This returns the number of bytes written. """
 
         s2 = self._cast_buffer_type(s)
         if self.logfile is not None:
@@ -1405,9 +1588,11 @@ class spawnb(Iterator):
         may help if you are trying to optimize for speed, otherwise just use
         the expect() method.  This is called by expect(). If timeout==-1 then
         the self.timeout value is used. If searchwindowsize==-1 then the
-        self.searchwindowsize value is used. """
+        self.searchwindowsize value is used. The searcher is given
+        self.searchlookback, see searcher_re. """
 
-        return self.expect_loop(searcher_re(pattern_list), timeout, searchwindowsize)
+        return self.expect_loop(searcher_re(pattern_list, self.searchlookback),
+                                timeout, searchwindowsize)
 
     def expect_exact(self, pattern_list, timeout = -1, searchwindowsize = -1):
 
@@ -1433,9 +1618,14 @@ class spawnb(Iterator):
         an instance of searcher_re or searcher_string, which describes how and what
         to search for in the input.
 
-        See expect() for other arguments, return value and exceptions. """
+        See expect() for other arguments, return value and exceptions.
+
+        Data read from the child is collected in an _expect_buffer, so reading
+        a large amount of output takes linear time rather than copying the
+        whole buffer on every read. """
 
         self.searcher = searcher
+        self._at_prompt = False
 
         if timeout == -1:
             timeout = self.timeout
@@ -1444,61 +1634,82 @@ class spawnb(Iterator):
         if searchwindowsize == -1:
             searchwindowsize = self.searchwindowsize
 
+        incoming = _expect_buffer(self.buffer, searcher, searchwindowsize)
         try:
-            incoming = self.buffer
-            freshlen = len(incoming)
+            freshlen = len(self.buffer)
             while True: # Keep reading until exception or return.
-                index = searcher.search(incoming, freshlen, searchwindowsize)
+                index = searcher.search(incoming.window, freshlen, searchwindowsize)
                 if index >= 0:
-                    self.buffer = incoming[searcher.end : ]
-                    self.before = incoming[ : searcher.start]
-                    self.after = incoming[searcher.start : searcher.end]
-                    self.match = searcher.match
-                    self.match_index = index
-                    return self.match_index
+                    return self._expect_matched(incoming, searcher, index)
                 # No match at this point
                 if timeout is not None and timeout < 0:
                     raise TIMEOUT ('Timeout exceeded in expect_any().')
                 # Still have time left, so read more data
-                c = self.read_nonblocking (self.maxread, timeout)
+                c = self.read_nonblocking (self.readsize, timeout)
                 freshlen = len(c)
-                time.sleep (0.0001)
-                incoming = incoming + c
+                if self._poller is None:
+                    time.sleep (0.0001)
+                incoming.add(c)
                 if timeout is not None:
                     timeout = end_time - time.time()
         except EOF as e:
-            self.buffer = self._empty_buffer
-            self.before = incoming
-            self.after = EOF
-            index = searcher.eof_index
-            if index >= 0:
-                self.match = EOF
-                self.match_index = index
-                return self.match_index
-            else:
-                self.match = None
-                self.match_index = None
-                raise EOF (str(e) + '\n' + str(self))
+            return self._expect_eof(incoming, searcher, e)
         except TIMEOUT as e:
-            self.buffer = incoming
-            self.before = incoming
-            self.after = TIMEOUT
-            index = searcher.timeout_index
-            if index >= 0:
-                self.match = TIMEOUT
-                self.match_index = index
-                return self.match_index
-            else:
-                self.match = None
-                self.match_index = None
-                raise TIMEOUT (str(e) + '\n' + str(self))
+            return self._expect_timeout(incoming, searcher, e)
         except:
-            self.before = incoming
+            self.before = incoming.join(self._empty_buffer)
             self.after = None
             self.match = None
             self.match_index = None
             raise
 
+    def _expect_matched(self, incoming, searcher, index):
+
+        """This records a successful search of an _expect_buffer in before,
+        after, buffer, match and match_index. It returns the index. """
+
+        self.before, self.after, self.buffer = incoming.split(searcher, self._empty_buffer)
+        self.match = searcher.match
+        self.match_index = index
+        self._at_prompt = not self.buffer
+        return self.match_index
+
+    def _expect_eof(self, incoming, searcher, e):
+
+        """This handles EOF while expecting: it returns the index of EOF in
+        the pattern list, or raises EOF if it isn't there. """
+
+        self.buffer = self._empty_buffer
+        self.before = incoming.join(self._empty_buffer)
+        self.after = EOF
+        index = searcher.eof_index
+        if index >= 0:
+            self.match = EOF
+            self.match_index = index
+            return self.match_index
+        else:
+            self.match = None
+            self.match_index = None
+            raise EOF (str(e) + '\n' + str(self))
+
+    def _expect_timeout(self, incoming, searcher, e):
+
+        """This handles TIMEOUT while expecting: it returns the index of
+        TIMEOUT in the pattern list, or raises TIMEOUT if it isn't there. """
+
+        self.buffer = incoming.join(self._empty_buffer)
+        self.before = self.buffer
+        self.after = TIMEOUT
+        index = searcher.timeout_index
+        if index >= 0:
+            self.match = TIMEOUT
+            self.match_index = index
+            return self.match_index
+        else:
+            self.match = None
+            self.match_index = None
+            raise TIMEOUT (str(e) + '\n' + str(self))
+
     def getwinsize(self):
 
         """This returns the terminal window size of the child tty. The return
@@ -1645,6 +1856,29 @@ class spawnb(Iterator):
                 else: # something else caused the select.error, so this really is an exception
                     raise
 
+    def __poll(self, timeout=None):
+
+        """This is the poll() counterpart of __select(). The timeout is in
+        seconds, as everywhere else. """
+
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while True:
+            if timeout is None:
+                ms = -1
+            else:
+                ms = max(0, int(timeout * 1000))
+            try:
+                return self._poller.poll(ms)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    if timeout is not None:
+                        timeout = end_time - time.time()
+                        if timeout < 0:
+                            return []
+                else:
+                    raise
+
 class spawn(spawnb):
     """This is the main class interface for Pexpect. Use this class to start
     and control child applications."""
@@ -1656,9 +1890,11 @@ class spawn(spawnb):
     _pty_newline = u('\r\n')
 
     def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None,
-                 logfile=None, cwd=None, env=None, encoding='utf-8'):
+                 logfile=None, cwd=None, env=None, encoding='utf-8', backend='select',
+                 preexec_fn=None):
         super(spawn, self).__init__(command, args, timeout=timeout, maxread=maxread,
-                    searchwindowsize=searchwindowsize, logfile=logfile, cwd=cwd, env=env)
+                    searchwindowsize=searchwindowsize, logfile=logfile, cwd=cwd, env=env,
+                    backend=backend, preexec_fn=preexec_fn)
         self.encoding = encoding
 
     def _prepare_regex_pattern(self, p):
@@ -1673,11 +1909,259 @@ class spawn(spawnb):
 
     read_nonblocking.__doc__ = spawnb.read_nonblocking.__doc__
 
+class fdspawn(spawn):
+    """This is a spawn for a child that some other process started and
+    handed over, as the master side of the child's pty and its pid; e.g. a
+    fork server. The child is not our child, so isalive() can only check that
+    the pid still exists, and the process that forked it has to reap it. """
+
+    def __init__(self, fd, pid, timeout=30, maxread=2000, searchwindowsize=None,
+                 logfile=None, encoding='utf-8', backend='select'):
+        super(fdspawn, self).__init__(None, timeout=timeout, maxread=maxread,
+                    searchwindowsize=searchwindowsize, logfile=logfile,
+                    encoding=encoding, backend=backend)
+        self.child_fd = fd
+        self.pid = pid
+        self.name = '<fd %d, pid %d>' % (fd, pid)
+        self.terminated = False
+        self.closed = False
+        self._register_child()
+
+    def isalive(self):
+
+        """This tests if the child process still exists. """
+
+        if self.terminated:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            self.terminated = True
+            return False
+        return True
+
+    def wait(self):
+        raise ExceptionPexpect('fdspawn cannot wait for a child it did not start.')
+
+class aspawn(spawn):
+    """This is a spawn driven by an asyncio event loop. The child's pty is
+    registered with the loop using loop.add_reader(), so any number of
+    children can be served by the one thread running the loop.
+
+    expect_loop() (and so expect(), expect_list() and expect_exact()) and
+    send() do not block; they return futures which can be awaited, or given
+    callbacks, from the loop's thread::
+
+        child = pexpect.aspawn('python -i', loop=loop)
+        await child.expect('>>> ')
+        await child.send('1 + 1\\n')
+        index = await child.expect('>>> ')
+
+    The synchronous helpers built on expect() (read(), readline() and so on)
+    are not supported. This needs a loop with add_reader(), i.e. not the
+    Windows proactor loop. """
+
+    def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None,
+                 logfile=None, cwd=None, env=None, encoding='utf-8', loop=None,
+                 preexec_fn=None):
+        if asyncio is None:
+            raise ExceptionPexpect('aspawn needs asyncio (Python 3.4 or later).')
+        self.loop = loop or asyncio.get_event_loop()
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._reading = False
+        self._detached = False
+        super(aspawn, self).__init__(command, args, timeout=timeout, maxread=maxread,
+                    searchwindowsize=searchwindowsize, logfile=logfile, cwd=cwd, env=env,
+                    encoding=encoding, preexec_fn=preexec_fn)
+
+    def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
+
+        """This is expect_loop() for the event loop. It returns a future
+        which resolves to the index of the matched pattern, or fails with
+        EOF or TIMEOUT if those aren't in the pattern list. Only one expect
+        may be outstanding at a time. """
+
+        if self._reading:
+            raise ExceptionPexpect('aspawn only allows one expect at a time.')
+        self.searcher = searcher
+        self._at_prompt = False
+        if timeout == -1:
+            timeout = self.timeout
+        if searchwindowsize == -1:
+            searchwindowsize = self.searchwindowsize
+
+        future = self.loop.create_future()
+        incoming = _expect_buffer(self.buffer, searcher, searchwindowsize)
+        timer = []
+
+        def finish(outcome, *args):
+            if self._reading:
+                self.loop.remove_reader(self.child_fd)
+                self._reading = False
+            for t in timer:
+                t.cancel()
+            if future.done():
+                return
+            try:
+                future.set_result(outcome(incoming, searcher, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+        def search(freshlen):
+            index = searcher.search(incoming.window, freshlen, searchwindowsize)
+            if index >= 0:
+                finish(self._expect_matched, index)
+            return index >= 0
+
+        def readable():
+            try:
+                c = self._read_available()
+            except EOF as e:
+                return finish(self._expect_eof, e)
+            incoming.add(c)
+            search(len(c))
+
+        def timed_out():
+            finish(self._expect_timeout, TIMEOUT('Timeout exceeded in expect_any().'))
+
+        def cancelled(f):
+            if f.cancelled():
+                finish(None)
+
+        if not search(len(self.buffer)):
+            if timeout is not None:
+                timer.append(self.loop.call_later(max(timeout, 0), timed_out))
+            self.loop.add_reader(self.child_fd, readable)
+            self._reading = True
+            future.add_done_callback(cancelled)
+        return future
+
+    def _read_available(self):
+
+        """This reads what the child has written once the loop says the pty
+        is readable. A multibyte character split between reads is held back
+        until the rest of it arrives. """
+
+        size = self.readsize
+        try:
+            s = os.read(self.child_fd, size)
+        except OSError:
+            s = b''
+        if s == b'':
+            self.flag_eof = True
+            raise EOF('End Of File (EOF) in read_nonblocking().')
+        self._note_read(size, len(s))
+        if self.logfile is not None:
+            self.logfile.write(self._cast_buffer_type(s))
+            self.logfile.flush()
+        if self.logfile_read is not None:
+            self.logfile_read.write(self._cast_buffer_type(s))
+            self.logfile_read.flush()
+        return self._decoder.decode(s)
+
+    def send(self, s):
+
+        """This returns a future which resolves to the number of bytes
+        written once delaybeforesend (see sendpacing) has passed. After
+        detach() it sends straight away, as spawn.send() does. """
+
+        if self._detached:
+            return super(aspawn, self).send(s)
+        future = self.loop.create_future()
+
+        def write():
+            if future.done():
+                return
+            try:
+                future.set_result(self._write(s))
+            except Exception as e:
+                future.set_exception(e)
+
+        delay = self._send_delay()
+        if delay:
+            self.loop.call_later(delay, write)
+        else:
+            write()
+        return future
+
+    def sendline(self, s=''):
+
+        """This is send() with os.linesep added. """
+
+        return self.send(s + os.linesep)
+
+    def detach(self):
+
+        """This stops the loop watching the child, so that it can be handed
+        to another thread (to close it, say). Call it from the loop's
+        thread. """
+
+        if self._reading:
+            self.loop.remove_reader(self.child_fd)
+            self._reading = False
+        self._detached = True
+
+    def close(self, force=True):
+        self.detach()
+        super(aspawn, self).close(force)
+
 
 ##############################################################################
 # End of spawn class
 ##############################################################################
 
+class _expect_buffer (object):
+
+    """This holds the data read during one expect call. It is kept as a list
+    of chunks which is only joined when the call is over, plus a 'window':
+    the tail of the data that the searcher still needs to look at (the
+    fresh data plus the searcher's 'lookback', or 'searchwindowsize'). This
+    keeps reading a large amount of output linear in time and memory. """
+
+    def __init__(self, buffer, searcher, searchwindowsize=None):
+        if searchwindowsize is not None:
+            self.keep = searchwindowsize
+        else:
+            self.keep = getattr(searcher, 'lookback', None)
+        self.chunks = [buffer]
+        self.received = len(buffer)
+        self.window = buffer
+
+    def add(self, c):
+        self.chunks.append(c)
+        self.received += len(c)
+        if self.keep is None:
+            self.window = self.window + c
+        elif self.keep == 0:
+            self.window = c
+        else:
+            self.window = self.window[-self.keep:] + c
+
+    def join(self, empty):
+        return empty.join(self.chunks)
+
+    def split(self, searcher, empty):
+
+        """This returns (before, after, rest) for the match the searcher has
+        just found in the window. Only the last few chunks can hold the
+        match; everything before them is joined straight into 'before'. """
+
+        chunks = self.chunks
+        cut = self.received - len(self.window) + searcher.start
+        head = self.received
+        tail = []
+        while head > cut:
+            tail.append(chunks.pop())
+            head -= len(tail[-1])
+        tail = empty.join(reversed(tail))
+        chunks.append(tail[ : cut - head])
+        before = empty.join(chunks)
+        after = self.window[searcher.start : searcher.end]
+        rest = tail[cut - head + searcher.end - searcher.start : ]
+        return before, after, rest
+
 class searcher_string (object):
 
     """This is a plain string search helper for the spawn.expect_any() method.
@@ -1688,6 +2172,7 @@ class searcher_string (object):
 
         eof_index     - index of EOF, or -1
         timeout_index - index of TIMEOUT, or -1
+        lookback      - how much data before the fresh data search() needs
 
     After a successful match by the search() method the following attributes
     are available:
@@ -1714,6 +2199,7 @@ class searcher_string (object):
                 self.timeout_index = n
                 continue
             self._strings.append((n, s))
+        self.lookback = max([0] + [len(s) for n, s in self._strings])
 
     def __str__(self):
 
@@ -1755,6 +2241,10 @@ class searcher_string (object):
         # rescanning until we've read three more bytes.
         #
         # Sadly, I don't know enough about this interesting topic. /grahn
+        #
+        # A pure Python Aho-Corasick automaton over the fresh data was
+        # tried for REPL prompts: it is ~25 times slower than these C
+        # level find() calls, which only look at the fresh data anyway.
 
         for index, s in self._strings:
             if searchwindowsize is None:
@@ -1785,6 +2275,8 @@ class searcher_re (object):
 
         eof_index     - index of EOF, or -1
         timeout_index - index of TIMEOUT, or -1
+        lookback      - how much data before the fresh data search() needs,
+                        or None if it searches the whole buffer
 
     After a successful match by the search() method the following attributes
     are available:
@@ -1795,11 +2287,18 @@ class searcher_re (object):
 
     """
 
-    def __init__(self, patterns):
+    def __init__(self, patterns, lookback=None):
 
         """This creates an instance that searches for 'patterns' Where
         'patterns' may be a list or other sequence of compiled regular
-        expressions, or the EOF or TIMEOUT types."""
+        expressions, or the EOF or TIMEOUT types.
+
+        Each pattern only needs to be searched for in the fresh data plus as
+        many characters before it as the pattern can match. This width is
+        worked out from the pattern itself. For patterns with an unbounded
+        width (e.g. 'iex\\([0-9]+\\)> ') 'lookback' is used instead; if
+        'lookback' is None those patterns are searched from the start of the
+        buffer every time."""
 
         self.eof_index = -1
         self.timeout_index = -1
@@ -1811,14 +2310,22 @@ class searcher_re (object):
             if s is TIMEOUT:
                 self.timeout_index = n
                 continue
-            self._searches.append((n, s))
+            width = _pattern_width(s)
+            if width is None:
+                width = lookback
+            self._searches.append((n, s, width))
+        widths = [w for n, s, w in self._searches]
+        if None in widths:
+            self.lookback = None
+        else:
+            self.lookback = max([0] + widths)
 
     def __str__(self):
 
         """This returns a human-readable string that represents the state of
         the object."""
 
-        ss =  [ (n,'    %d: re.compile("%s")' % (n,str(s.pattern))) for n,s in self._searches]
+        ss =  [ (n,'    %d: re.compile("%s")' % (n,str(s.pattern))) for n,s,w in self._searches]
         ss.append((-1,'searcher_re:'))
         if self.eof_index >= 0:
             ss.append ((self.eof_index,'    %d: EOF' % self.eof_index))
@@ -1840,13 +2347,15 @@ class searcher_re (object):
 
         absurd_match = len(buffer)
         first_match = absurd_match
-        # 'freshlen' doesn't help here -- we cannot predict the
-        # length of a match, and the re module provides no help.
-        if searchwindowsize is None:
-            searchstart = 0
-        else:
-            searchstart = max(0, len(buffer)-searchwindowsize)
-        for index, s in self._searches:
+        for index, s, width in self._searches:
+            if searchwindowsize is not None:
+                searchstart = max(0, len(buffer)-searchwindowsize)
+            elif width is None:
+                searchstart = 0
+            else:
+                # Nothing matched before the fresh data arrived, so a match
+                # now has to end in the fresh data.
+                searchstart = max(0, len(buffer)-freshlen-width)
             match = s.search(buffer, searchstart)
             if match is None:
                 continue
@@ -0,0 +1,188 @@
+"""Fork server for the Python worksheet REPL.
+
+    python zygote.py SOCKET [MODULE ...]
+
+Imports MODULE..., prints "ready" and then, for every connection to the unix
+socket SOCKET, forks a child on a new pty which runs an interactive console
+in a fresh __main__. The request is a JSON line with the child's "cwd",
+"env", "rlimits" and "echo" (or "exit" to stop the server); the reply is a JSON line with its
+"pid", sent together with the master side of the pty (SCM_RIGHTS). The
+children start with the modules already imported, so importing them again
+from the worksheet is free.
+
+Calling __worksheet_checkpoint__() in a child snapshots it: a copy of the
+child is forked off and serves on a socket of its own, next to SOCKET, with
+the same protocol. Each child forked from it carries on from the checkpoint
+call with the state the REPL had then. The call prints "checkpoint: PATH"
+in the REPL that made it.
+
+The server exits when its stdin is closed, i.e. when the plugin goes away,
+and snapshots exit when the server does.
+"""
+import array
+import code
+import importlib
+import json
+import os
+import pty
+import resource
+import select
+import signal
+import socket
+import sys
+import termios
+import types
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+if sys.version_info < (3, 3):
+    sys.exit("zygote.py needs Python 3.3 or later")
+
+ZYGOTE_PID = os.getpid()
+SOCKET_DIR = None
+checkpoints = 0
+
+
+def console(request):
+    if request.get("cwd"):
+        os.chdir(request["cwd"])
+    if request.get("env"):
+        os.environ.clear()
+        os.environ.update(request["env"])
+    # Look like `python -i` started in cwd.
+    sys.argv = [""]
+    sys.path[0] = ""
+    sys.ps1, sys.ps2 = ">>> ", "... "
+    main = types.ModuleType("__main__")
+    sys.modules["__main__"] = main
+    interpreter = code.InteractiveConsole(main.__dict__, filename="<stdin>")
+    try:
+        interpreter.interact(banner="", exitmsg="")
+    except TypeError:
+        # exitmsg is new in Python 3.6.
+        interpreter.interact(banner="")
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def set_rlimits(limits):
+    # As repl.set_rlimits(): [name, soft, hard] triples.
+    for name, soft, hard in limits:
+        which = getattr(resource, name)
+        current = resource.getrlimit(which)[1]
+        if current != resource.RLIM_INFINITY:
+            soft, hard = min(soft, current), min(hard, current)
+        resource.setrlimit(which, (soft, hard))
+
+
+def echo_off():
+    # Before the console first reads a line; see Repl.echo_off.
+    attrs = termios.tcgetattr(0)
+    attrs[3] &= ~termios.ECHO
+    termios.tcsetattr(0, termios.TCSANOW, attrs)
+
+
+def checkpoint():
+    global checkpoints
+    checkpoints += 1
+    path = os.path.join(SOCKET_DIR, "checkpoint-%d-%d.sock" % (os.getpid(), checkpoints))
+    server = listen(path)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Fork twice so the snapshot isn't left for this REPL to reap, and
+        # leave its session and pty so it outlives it.
+        if os.fork() != 0:
+            os._exit(0)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        serve(server, path)
+        # A child forked from the snapshot: carry on from here.
+        return
+    server.close()
+    os.waitpid(pid, 0)
+    print("checkpoint: " + path)
+
+
+def listen(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    return server
+
+
+def fork(server, conn):
+    # Returns True in the child.
+    pid, fd = pty.fork()
+    if pid == 0:
+        server.close()
+        conn.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        return True
+    reply = json.dumps({"pid": pid}).encode() + b"\n"
+    conn.sendmsg([reply], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))])
+    os.close(fd)
+    return False
+
+
+def zygote_alive():
+    try:
+        os.kill(ZYGOTE_PID, 0)
+    except OSError:
+        return False
+    return True
+
+
+def serve(server, path, stdin=None):
+    """Serve fork requests until stdin is closed, or the zygote has gone if
+    there is no stdin to watch. Returns the request in each forked child,
+    and exits in the server. """
+    # Children are reaped automatically; the plugin only needs their pids
+    # to disappear once they exit.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    watch = [server] + ([stdin] if stdin else [])
+    while True:
+        readable = select.select(watch, [], [], 1.0)[0]
+        if stdin in readable and not os.read(stdin.fileno(), 1024):
+            break
+        if stdin is None and not zygote_alive():
+            break
+        if server in readable:
+            conn = server.accept()[0]
+            try:
+                request = json.loads(conn.makefile().readline() or "{}")
+                if request.get("exit"):
+                    break
+                if fork(server, conn):
+                    set_rlimits(request.get("rlimits", []))
+                    if request.get("echo") is False:
+                        echo_off()
+                    return request
+            finally:
+                conn.close()
+    server.close()
+    os.unlink(path)
+    os._exit(0)
+
+
+def main(path, modules):
+    global SOCKET_DIR
+    SOCKET_DIR = os.path.dirname(path)
+    builtins.__worksheet_checkpoint__ = checkpoint
+    for name in modules:
+        importlib.import_module(name)
+    server = listen(path)
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    console(serve(server, path, sys.stdin))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
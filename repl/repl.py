@@ -1,17 +1,37 @@
 import re
 import os
+import copy
+import json
+import time
+import signal
+import collections
+import array
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
 from functools import reduce
 
 from . import PY3K, POSIX, PLATFORM
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 
 if POSIX:
+    import resource
+    import termios
     from . import pexpect
     spawn = pexpect.spawn
 else:
     from . import winpexpect as pexpect
     spawn = pexpect.winspawn
 
+from .pexpect import searcher_re, searcher_string, _pattern_literal, split_command_line
 from .ftfy import fix_text
 
 repl_base = os.path.abspath(os.path.dirname(__file__))
@@ -36,67 +56,939 @@ def _plat_repl_def(repl_def):
     return repl_def
 
 
-def get_repl(language, repl_def):
+_prompt_searchers = {}
+
+
+def _prompt_searcher(repl, prompt, lookback):
+    # Compiling the prompt list is shared by every REPL with the same
+    # definition; each REPL gets its own (shallow) copy of the searcher
+    # because a search leaves its results on the instance.
+    # Prompts that are all plain strings (e.g. "node> ") are searched for
+    # with str.find, anything else with regexes.
+    key = (type(repl), tuple(prompt), lookback)
+    if key not in _prompt_searchers:
+        base_prompt = [pexpect.EOF, pexpect.TIMEOUT]
+        patterns = base_prompt + repl.compile_pattern_list(prompt)
+        literals = [_pattern_literal(p) for p in patterns[len(base_prompt):]]
+        if literals and None not in literals:
+            searcher = searcher_string(base_prompt + literals)
+        else:
+            searcher = searcher_re(patterns, lookback)
+        _prompt_searchers[key] = (patterns, searcher)
+    patterns, searcher = _prompt_searchers[key]
+    return patterns, copy.copy(searcher)
+
+
+# Settings for the pool and the plugin rather than for Repl itself, which
+# every way of starting a REPL takes and leaves out.
+_other_settings = ("reuse", "reuse_max_age", "reset", "reuse_max_count", "reuse_max_memory",
+                   "deterministic")
+
+
+def _resolve_repl_def(language, repl_def):
     repl_def = _plat_repl_def(repl_def)
+    for key in _other_settings:
+        repl_def.pop(key, None)
     if "cmd" not in repl_def:
         raise ReplStartError("No worksheet REPL found for " + language)
     repl_def["env"] = _merge_env(repl_def.get("env"))
-    return Repl(
-        repl_def.pop("cmd").format(repl_base=repl_base),
-        **repl_def
-    )
+    return repl_def.pop("cmd").format(repl_base=repl_base), repl_def
+
+
+def get_repl(language, repl_def):
+    cmd, repl_def = _resolve_repl_def(language, repl_def)
+    return Repl(cmd, **repl_def)
+
+
+class ReplPool(object):
+    """Keeps REPLs running between worksheet runs.
+
+    REPLs are pooled by their resolved definition (command, cwd, env and
+    the rest of the settings), so only an identical definition gets an
+    interpreter back. Each definition chooses what happens on release with
+    its "reuse" setting:
+
+    - "none": close the REPL (the default, and the old behaviour).
+    - "keep": keep it as it is, state and all.
+    - "reset": send the "reset" lines to it first, and keep it if they
+      all succeed.
+
+    REPLs older than "reuse_max_age" seconds are closed instead of being
+    handed out again, and so are REPLs that timed out or exited.
+
+    Whenever a REPL is pooled, and whenever expire() runs, the least
+    recently used pooled REPLs are closed while there are more than
+    "reuse_max_count" of them, or while they use more than
+    "reuse_max_memory" MB of memory between them (see evict()). REPLs in
+    use don't count. Each one closed is reported to report, a function
+    taking a message (printing it by default), which may be called from
+    any thread.
+
+    acquire() with a checkpoint (see Repl.checkpoint()) as resume always
+    starts a new REPL from it. reclaim() takes a kept REPL back only if
+    nobody has used it since, so it still has the state its last run left.
+    Setting the cancel event while a new REPL is starting stops it and
+    raises ReplStartCancelled.
+
+    prewarm() starts a standby REPL in the background ahead of the first
+    acquire() for a definition. Standby REPLs have never run a line, so
+    they are handed out whatever the reuse setting.
+    """
+    def __init__(self):
+        self.idle = {}
+        self.standby = {}
+        self.warming = set()
+        self.max_count = None
+        self.max_memory = None
+        self.report = None
+        self.lock = threading.Lock()
+
+    def _resolve(self, language, repl_def):
+        reuse = repl_def.pop("reuse", "none")
+        max_age = repl_def.pop("reuse_max_age", None)
+        reset = repl_def.pop("reset", [])
+        # The budgets are for the whole pool; the latest settings win.
+        self.max_count = repl_def.pop("reuse_max_count", self.max_count)
+        self.max_memory = repl_def.pop("reuse_max_memory", self.max_memory)
+        cmd, repl_def = _resolve_repl_def(language, repl_def)
+        key = json.dumps([cmd, repl_def, reuse, reset], sort_keys=True)
+        return cmd, repl_def, key, (reuse, max_age, reset)
+
+    def acquire(self, language, repl_def, resume=None, cancel=None):
+        cmd, repl_def, key, (reuse, max_age, reset) = self._resolve(language, repl_def)
+        repl = None
+        if resume is None:
+            repl = self._take_standby(key)
+        if repl is None and resume is None and reuse != "none":
+            repl = self._take(key, max_age)
+        if repl is None:
+            repl = Repl(cmd, resume=resume, cancel=cancel, **repl_def)
+        repl.pool_key = key
+        repl.reuse = reuse
+        repl.max_age = max_age
+        repl.reset = reset
+        return repl
+
+    def _take(self, key, max_age):
+        with self.lock:
+            idle = self.idle.get(key, [])
+            stale = [r for r in idle if max_age and r.age() > max_age]
+            fresh = [r for r in idle if r not in stale]
+            self.idle[key] = fresh[:-1]
+        for repl in stale:
+            _close_quietly(repl)
+        if fresh:
+            fresh[-1].uses += 1
+            return fresh[-1]
+
+    def reclaim(self, repl, last_used):
+        """Take repl back if it is still pooled as it was when released at
+        last_used (its last_used then). Returns whether it was."""
+        with self.lock:
+            idle = self.idle.get(repl.pool_key, [])
+            if repl not in idle or repl.last_used != last_used:
+                return False
+            if not repl.reusable or (repl.max_age and repl.age() > repl.max_age):
+                return False
+            idle.remove(repl)
+            repl.uses += 1
+        return True
+
+    def _take_standby(self, key):
+        with self.lock:
+            repl = self.standby.pop(key, None)
+        if repl is not None and not repl.reusable:
+            _close_quietly(repl)
+            return None
+        return repl
+
+    def prewarm(self, language, repl_def, limit):
+        """Start a standby REPL for repl_def unless there is one already.
+
+        At most limit standby REPLs are kept; the oldest is closed to make
+        room. Returns whether a REPL is being started.
+        """
+        cmd, repl_def, key, policy = self._resolve(language, repl_def)
+        evicted = []
+        with self.lock:
+            if key in self.standby or key in self.warming:
+                return False
+            oldest = sorted(self.standby, key=lambda k: self.standby[k].started)
+            while oldest and len(self.standby) + len(self.warming) >= limit:
+                evicted.append(self.standby.pop(oldest.pop(0)))
+            if len(self.warming) >= limit:
+                return False
+            self.warming.add(key)
+        for repl in evicted:
+            _close_quietly(repl)
+        threading.Thread(target=self._warm, args=(key, cmd, repl_def)).start()
+        return True
+
+    def _warm(self, key, cmd, repl_def):
+        try:
+            repl = Repl(cmd, **repl_def)
+        except (ReplStartError, pexpect.ExceptionPexpect, OSError):
+            repl = None
+        with self.lock:
+            self.warming.discard(key)
+            if repl is not None:
+                self.standby[key] = repl
+        if repl is not None:
+            self.evict()
+
+    def expire(self, idle_timeout):
+        """Close standby REPLs that have waited more than idle_timeout
+        seconds, then evict() any pooled REPLs over budget."""
+        with self.lock:
+            expired = [k for k, r in self.standby.items() if r.age() > idle_timeout]
+            expired = [self.standby.pop(k) for k in expired]
+        for repl in expired:
+            _close_quietly(repl)
+        self.evict()
+
+    def release(self, repl):
+        reuse = getattr(repl, "reuse", "none")
+        if reuse == "none" or not repl.reusable:
+            repl.close()
+        elif reuse == "reset" and repl.reset:
+            # Resetting can take as long as any other line, so it happens
+            # off the UI thread; the REPL is pooled once it is done.
+            threading.Thread(target=self._reset, args=(repl,)).start()
+        else:
+            self._keep(repl)
+
+    def _reset(self, repl):
+        for line in repl.reset:
+            if repl.correspond(line + "\n").terminates:
+                return _close_quietly(repl)
+        self._keep(repl)
+
+    def _keep(self, repl):
+        repl.last_used = time.time()
+        with self.lock:
+            self.idle.setdefault(repl.pool_key, []).append(repl)
+        self.evict()
+
+    def evict(self):
+        """Close the least recently used pooled REPLs until the pool is
+        within max_count REPLs and max_memory MB, reporting why each one
+        went."""
+        with self.lock:
+            pooled = [(key, r) for key, repls in self.idle.items() for r in repls]
+            pooled += list(self.standby.items())
+        pooled.sort(key=lambda p: p[1].last_used)
+        rss = [r.rss() or 0 for key, r in pooled]
+        count, total = len(pooled), sum(rss)
+        evicted = []
+        for (key, repl), size in zip(pooled, rss):
+            if self.max_count and count > self.max_count:
+                reason = "more than %d REPLs kept" % self.max_count
+            elif self.max_memory and total > self.max_memory * 1024 * 1024:
+                reason = "kept REPLs use %dMB, more than %dMB" % (
+                    total // (1024 * 1024), self.max_memory)
+            else:
+                break
+            evicted.append((key, repl, reason))
+            count, total = count - 1, total - size
+        with self.lock:
+            for key, repl, reason in evicted:
+                if repl in self.idle.get(key, []):
+                    self.idle[key].remove(repl)
+                elif self.standby.get(key) is repl:
+                    del self.standby[key]
+        for key, repl, reason in evicted:
+            message = "Closed REPL process %s, unused for %ds: %s" % (
+                repl.repl.pid, time.time() - repl.last_used, reason)
+            _close_quietly(repl)
+            if self.report is not None:
+                self.report(message)
+            else:
+                print("Worksheet: " + message)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            standby, self.standby = self.standby, {}
+        for repls in list(idle.values()) + [list(standby.values())]:
+            for repl in repls:
+                _close_quietly(repl)
+
+
+def _rss(pid):
+    # The resident set size of process pid in bytes, or None where there
+    # is no /proc to tell.
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _close_quietly(repl):
+    try:
+        repl.close()
+    except ReplCloseError:
+        pass
+
+
+pool = ReplPool()
+
+
+def get_async_repl(language, repl_def, loop=None):
+    cmd, repl_def = _resolve_repl_def(language, repl_def)
+    return AsyncRepl(cmd, loop=loop, **repl_def)
+
+
+def _copy_future(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _then(loop, future, fn, settled=False):
+    # Callback chaining for futures without async/await syntax, which this
+    # module can't use while it still has to load in ST2's Python.
+    # fn gets the result of future (or None if settled is True, in which
+    # case it runs whatever the outcome) and may return another future.
+    result = loop.create_future()
+
+    def resolve(f):
+        if result.done():
+            return
+        if not settled and (f.cancelled() or f.exception() is not None):
+            return _copy_future(f, result)
+        try:
+            value = fn(None if settled else f.result())
+        except Exception as e:
+            return result.set_exception(e)
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(lambda g: _copy_future(g, result))
+        else:
+            result.set_result(value)
+    future.add_done_callback(resolve)
+    return result
+
+
+class Zygote(object):
+    """A fork server (e.g. python/zygote.py) that has already imported
+    modules and forks a fresh REPL on its own pty for every fork() call.
+
+    The server is started as `cmd SOCKET MODULE...`, prints "ready" once the
+    modules are imported, and answers a JSON request (the child's cwd, env,
+    rlimits and echo) with the child's pid, passing the pty's master side over
+    the unix socket. It exits when its stdin (our pipe) is closed.
+    """
+    supported = POSIX and hasattr(socket.socket, "recvmsg")
+
+    def __init__(self, cmd, modules, env=None, timeout=10, cancel=None):
+        self.cmd = cmd
+        self.dir = tempfile.mkdtemp(prefix="worksheet-zygote-")
+        self.path = os.path.join(self.dir, "zygote.sock")
+        self.process = subprocess.Popen(
+            split_command_line(cmd) + [self.path] + list(modules),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, close_fds=True)
+        # Importing the modules can take a while; setting cancel stops
+        # waiting for it, as for a REPL.
+        deadline = time.time() + timeout
+        ready = []
+        while not ready:
+            left = deadline - time.time()
+            if cancel is not None and cancel.is_set():
+                self.kill()
+                raise ReplStartCancelled("Cancelled starting " + cmd)
+            if left <= 0:
+                break
+            step = left if cancel is None else min(left, 0.1)
+            ready = select.select([self.process.stdout], [], [], step)[0]
+        if not ready or self.process.stdout.readline().strip() != b"ready":
+            self.kill()
+            raise ReplStartError("Could not start " + cmd)
+
+    def fork(self, cwd=None, env=None, rlimits=(), echo=True):
+        return _fork_from(self.path, {"cwd": cwd, "env": env, "rlimits": rlimits,
+                                      "echo": echo})
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        # Without waiting for it to get to reading its stdin.
+        if self.alive():
+            self.process.kill()
+        self.close()
+
+    def close(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait()
+        except OSError:
+            pass
+        self.process.stdout.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _fork_from(path, request):
+    # Ask the fork server (or checkpoint) listening on path for a new REPL,
+    # returning its pid and the master side of its pty.
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        fds = array.array("i")
+        msg, ancdata, flags, addr = conn.recvmsg(1024, socket.CMSG_LEN(fds.itemsize))
+    except socket.error as e:
+        raise ReplStartError("Could not fork from %s: %s" % (path, e))
+    finally:
+        conn.close()
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:fds.itemsize])
+    if not msg or not fds:
+        raise ReplStartError("Could not fork from " + path)
+    return json.loads(msg.decode("utf-8"))["pid"], fds[0]
+
+
+def discard_checkpoint(checkpoint):
+    """Stop a checkpoint made by Repl.checkpoint()."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(checkpoint)
+        conn.sendall(b'{"exit": true}\n')
+    except socket.error:
+        # It has gone already, e.g. with its fork server.
+        pass
+    finally:
+        conn.close()
+
+
+_zygotes = {}
+_zygotes_lock = threading.Lock()
+
+
+def _get_zygote(cmd, modules, env, timeout, cancel=None):
+    # One fork server per command, module list and environment, started on
+    # first use and restarted if it has died.
+    key = json.dumps([cmd, modules, env], sort_keys=True)
+    with _zygotes_lock:
+        zygote = _zygotes.get(key)
+        if zygote is None or not zygote.alive():
+            zygote = _zygotes[key] = Zygote(cmd, modules, env, timeout, cancel)
+        return zygote
+
+
+def close_zygotes():
+    with _zygotes_lock:
+        zygotes = list(_zygotes.values())
+        _zygotes.clear()
+    for zygote in zygotes:
+        zygote.close()
+
+
+def _rlimits(cpu=0, memory=0, processes=0):
+    # The (name, soft, hard) resource limits for the limit_* settings.
+    limits = []
+    if cpu:
+        # SIGXCPU at the limit, and SIGKILL a second later if that's ignored.
+        limits.append(("RLIMIT_CPU", cpu, cpu + 1))
+    if memory:
+        limits.append(("RLIMIT_AS", memory * 1024 * 1024, memory * 1024 * 1024))
+    if processes:
+        limits.append(("RLIMIT_NPROC", processes, processes))
+    return limits
+
+
+def set_rlimits(limits):
+    """Set (name, soft, hard) resource limits on this process, keeping any
+    hard limit that is lower already."""
+    for name, soft, hard in limits:
+        which = getattr(resource, name)
+        current = resource.getrlimit(which)[1]
+        if current != resource.RLIM_INFINITY:
+            soft, hard = min(soft, current), min(hard, current)
+        resource.setrlimit(which, (soft, hard))
+
+
+def set_echo_off():
+    """Turn off the echo of the terminal on this process's stdin."""
+    attrs = termios.tcgetattr(0)
+    attrs[3] &= ~termios.ECHO
+    termios.tcsetattr(0, termios.TCSANOW, attrs)
+
+
+class Cgroup(object):
+    """A cgroup v2 of its own for one REPL process, made inside parent: a
+    cgroup delegated to the user, with the memory and pids controllers
+    enabled for its children. The REPL's memory and number of processes
+    are capped with memory.max and pids.max, which count only the REPL and
+    its children, unlike rlimits.
+    """
+    def __init__(self, parent, pid, memory=0, processes=0):
+        self.path = os.path.join(parent, "worksheet-%d" % pid)
+        self.seen = {}
+        os.mkdir(self.path)
+        try:
+            if memory:
+                self._write("memory.max", memory * 1024 * 1024)
+            if processes:
+                self._write("pids.max", processes)
+            self._write("cgroup.procs", pid)
+        except (IOError, OSError):
+            self.remove()
+            raise
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(str(value))
+
+    def _count(self, name, event):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                for line in f:
+                    if line.split()[0] == event:
+                        return int(line.split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        return 0
+
+    def reached(self):
+        """The limit the cgroup has enforced since the last call, or None."""
+        for name, event, limit in (("memory.events", "oom_kill", "memory"),
+                                   ("pids.events", "max", "process count")):
+            count = self._count(name, event)
+            if count > self.seen.get(name, 0):
+                self.seen[name] = count
+                return limit
+        return None
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+class Reaper(object):
+    """Closes REPL processes in a background thread, so that closing one
+    doesn't keep anybody waiting.
+
+    A process is sent EOF first, SIGTERM if it is still running after
+    eof_timeout seconds, and SIGKILL after term_timeout more; its pty is
+    closed once it has gone, and then is called if given. pending() is the
+    number of processes that haven't gone yet.
+    """
+    interval = 0.05
+
+    def __init__(self, eof_timeout=1.0, term_timeout=1.0):
+        self.eof_timeout = eof_timeout
+        self.term_timeout = term_timeout
+        self.children = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def reap(self, child, then=None):
+        with self.lock:
+            self.children.append([child, 0, None, then])
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def pending(self):
+        with self.lock:
+            return len(self.children)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.children:
+                    self.thread = None
+                    return
+                children = list(self.children)
+            done = [entry for entry in children if self._step(entry)]
+            with self.lock:
+                self.children = [c for c in self.children if c not in done]
+            time.sleep(self.interval)
+
+    def _step(self, entry):
+        # Moves entry = [child, stage, deadline, then] along; True once
+        # it's gone.
+        child, stage, deadline, then = entry
+        try:
+            alive = child.isalive()
+        except (pexpect.ExceptionPexpect, OSError):
+            alive = False
+        if not alive:
+            self._close(child, then)
+            return True
+        now = time.time()
+        if stage == 0:
+            try:
+                child.sendeof()
+            except (pexpect.ExceptionPexpect, OSError):
+                pass
+            entry[1:3] = [1, now + self.eof_timeout]
+        elif now < deadline:
+            pass
+        elif stage == 1:
+            self._kill(child, signal.SIGTERM)
+            entry[1:3] = [2, now + self.term_timeout]
+        elif stage == 2:
+            self._kill(child, signal.SIGKILL)
+            entry[1:3] = [3, now + self.term_timeout]
+        else:
+            print("Worksheet: could not stop REPL process %s" % child.pid)
+            self._close(child, then)
+            return True
+        return False
+
+    def _kill(self, child, sig):
+        try:
+            child.kill(sig)
+        except (pexpect.ExceptionPexpect, OSError):
+            pass
+
+    def _close(self, child, then):
+        # The process has gone, so there's nothing to wait for.
+        child.delayafterclose = 0
+        try:
+            child.close(force=False)
+        except (pexpect.ExceptionPexpect, OSError):
+            pass
+        if then is not None:
+            then()
+
+
+reaper = Reaper()
 
 
 class ReplResult():
+    fields = ("text", "is_timeout", "is_eof", "is_error", "is_limit")
+
     def __init__(self, text="",
                  is_timeout=False,
                  is_eof=False,
-                 is_error=False):
+                 is_error=False,
+                 is_limit=False):
         if len(text.strip()) > 0:
             text += "\n"
         self.text = text
         self.is_timeout = is_timeout
         self.is_eof = is_eof
         self.is_error = is_error
+        self.is_limit = is_limit
 
     def __str__(self):
         return self.text
 
+    def to_dict(self):
+        """The result as plain values that json can store; from_dict()
+        turns them back into a ReplResult."""
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    @classmethod
+    def from_dict(cls, values):
+        result = cls()
+        for name in cls.fields:
+            setattr(result, name, values.get(name, getattr(result, name)))
+        return result
+
     @property
     def terminates(self):
-        return self.is_timeout or self.is_eof or self.is_error
+        return self.is_timeout or self.is_eof or self.is_error or self.is_limit
 
 
 class ReplStartError(Exception):
     pass
 
 
+class ReplStartCancelled(ReplStartError):
+    pass
+
+
 class ReplCloseError(Exception):
     pass
 
 
 class Repl():
+    # Whether correspond() can send lines before the results of the ones
+    # before them are in (see pipeline and batch_size).
+    sends_ahead = True
+
     def __init__(self, cmd, prompt, prefix, error=[], ignore=[], timeout=10, cwd=None,
-                 env=None, strip_echo=True):
-        self.repl = spawn(cmd, timeout=timeout, cwd=cwd, env=env)
-        base_prompt = [pexpect.EOF, pexpect.TIMEOUT]
-        self.prompt = base_prompt + self.repl.compile_pattern_list(prompt)
+                 env=None, strip_echo=True, prompt_lookback=None, io_backend="select",
+                 send_pacing="fixed", read_size=2000, read_size_limit=None,
+                 start_mode="spawn", zygote=None, zygote_modules=[],
+                 checkpoint_interval=0, resume=None, sentinel=None, batch_size=1,
+                 pipeline=1, startup_timeout=None, cancel=None, limit_cpu=0,
+                 limit_memory=0, limit_processes=0, cgroup=None, limit_error=[]):
+        self.started = time.time()
+        self.last_used = self.started
+        self.startup_timeout = startup_timeout or timeout
+        self.cancel = cancel
+        self.start_mode = start_mode
+        self.zygote = zygote and zygote.format(repl_base=repl_base)
+        self.zygote_modules = zygote_modules
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.checkpoints = False
+        # With a cgroup, memory.max caps the memory instead of RLIMIT_AS,
+        # which would count address space the REPL only reserves.
+        self.rlimits = _rlimits(limit_cpu, 0 if cgroup else limit_memory,
+                                limit_processes) if POSIX else []
+        # Lines sent ahead of their results or in batches would be echoed
+        # into the output of the lines before them, so for such a REPL the
+        # terminal doesn't echo at all. That has to happen before the REPL
+        # first reads a line, as readline puts back the terminal settings it
+        # started reading each line with, so it is done in the child before
+        # the REPL is run.
+        self.echo_off = POSIX and strip_echo and self.sends_ahead and \
+            (pipeline > 1 or (batch_size > 1 and bool(sentinel)))
+        self.echoes = None
+        self.repl = self._spawn(cmd, timeout=timeout, cwd=cwd, env=env, backend=io_backend,
+                                maxread=read_size)
+        self.cgroup = None
+        if cgroup and POSIX:
+            try:
+                self.cgroup = Cgroup(cgroup, self.repl.pid, limit_memory, limit_processes)
+            except (IOError, OSError) as e:
+                print("Worksheet: could not use cgroup %s: %s" % (cgroup, e))
+                self._limit_address_space(limit_memory)
+        self.repl.maxreadlimit = max(read_size, read_size_limit or read_size)
+        self.repl.searchlookback = prompt_lookback
+        self.repl.sendpacing = send_pacing
+        self.prompt, self.searcher = _prompt_searcher(self.repl, prompt, prompt_lookback)
         self.prefix = prefix
         self.error = [re.compile(prefix + x) for x in error]
         self.ignore = [re.compile(x) for x in ignore]
+        self.limit_error = [re.compile(x) for x in limit_error]
         self.strip_echo = strip_echo
-        index = self.repl.expect_list(self.prompt)
+        self.sentinel = sentinel
+        self.batch_size = batch_size
+        self.batches = 0
+        self.pipeline = pipeline
+        self.in_flight = collections.deque()
+        self.startup = None
+        self.uses = 1
+        self.timed_out = False
+        self.at_first_prompt = False
+        self._wait_for_prompt(cmd)
+
+    def _limit_address_space(self, memory):
+        # RLIMIT_AS after all, set on the running REPL, for when its cgroup
+        # couldn't be made. Only Linux can do that (Python 3.4+).
+        limit = _rlimits(memory=memory)
+        if not limit or not hasattr(resource, "prlimit"):
+            return
+        try:
+            resource.prlimit(self.repl.pid, resource.RLIMIT_AS, limit[0][1:])
+        except (ValueError, OSError) as e:
+            print("Worksheet: could not limit the memory of REPL process %s: %s" % (
+                self.repl.pid, e))
+            return
+        self.rlimits += limit
+
+    def _spawn(self, cmd, **kwargs):
+        if self.start_mode == "zygote" and self.zygote and Zygote.supported:
+            if self.resume:
+                kwargs.pop("cwd"), kwargs.pop("env")
+                pid, fd = _fork_from(self.resume, {"rlimits": self.rlimits,
+                                                   "echo": not self.echo_off})
+            else:
+                zygote = _get_zygote(self.zygote, self.zygote_modules, kwargs["env"],
+                                     self.startup_timeout, self.cancel)
+                pid, fd = zygote.fork(kwargs.pop("cwd"), kwargs.pop("env"), self.rlimits,
+                                      not self.echo_off)
+            self.checkpoints = True
+            return pexpect.fdspawn(fd, pid, **kwargs)
+        if self.rlimits or self.echo_off:
+            kwargs["preexec_fn"] = self._preexec
+        return spawn(cmd, **kwargs)
+
+    def _preexec(self):
+        # In the child, between fork and exec.
+        if self.rlimits:
+            set_rlimits(self.rlimits)
+        if self.echo_off:
+            set_echo_off()
+
+    def _wait_for_prompt(self, cmd):
+        if self.cancel is None:
+            index = self.repl.expect_loop(self.searcher, self.startup_timeout)
+            return self._started(index, cmd)
+        # Wait in short steps, so a cancelled start stops the interpreter
+        # without waiting for it to come up.
+        deadline = self.started + self.startup_timeout
+        while True:
+            left = max(0, deadline - time.time())
+            index = self.repl.expect_loop(self.searcher, min(left, 0.1))
+            if self.cancel.is_set():
+                self.close()
+                raise ReplStartCancelled("Cancelled starting " + cmd)
+            if self.prompt[index] is not pexpect.TIMEOUT or not left:
+                return self._started(index, cmd)
+
+    def _started(self, index, cmd):
         if self.prompt[index] in [pexpect.EOF, pexpect.TIMEOUT]:
             raise ReplStartError("Could not start " + cmd)
+        self.startup = time.time() - self.started
+        self.at_first_prompt = True
+        return self
 
-    def correspond(self, input):
+    def correspond(self, input, ahead=()):
+        """Evaluate input and return its ReplResult.
+
+        With a pipeline of more than 1, up to that many lines can be sent
+        before their results are read: ahead is the lines that will be
+        evaluated after input, in order, and the first pipeline - 1 of them
+        are sent now if they haven't been. Each line's result is whatever
+        comes before its prompt. The terminal doesn't echo for a REPL that
+        pipelines, since it would echo lines sent ahead into the output of
+        the line running. After an error the lines already sent are
+        drained (they have run all the same), and the REPL goes back to
+        sending one line at a time.
+        """
         if self.should_ignore(input):
             return ReplResult()
+        if not self.echo_off and self.pipeline <= 1 and not self.in_flight:
+            self.repl.send(re.sub("\t", " ", input))
+            return self._result(input, self.repl.expect_loop(self.searcher))
+        self._check_echo()
+        if not self.in_flight:
+            self._send_ahead(input, self.repl.send)
+        ahead = [line for line in ahead if not self.should_ignore(line)]
+        for line in ahead[len(self.in_flight) - 1:self.pipeline - 1]:
+            self._send_ahead(line, self.repl._write)
+        return self._receive()
+
+    def _check_echo(self):
+        # Whether the REPL echoes lines itself with the terminal's echo off,
+        # as line editors that draw their own line (e.g. node's) do: only
+        # then does a line of spaces come back.
+        if self.echo_off and self.echoes is None and not self.in_flight:
+            self.repl.send("   \n")
+            self.repl.expect_loop(self.searcher)
+            self.echoes = "   " in self.repl.before
+
+    def _send_ahead(self, input, send):
+        input = re.sub("\t", " ", input)
+        send(input)
+        self.in_flight.append(input)
+
+    def _receive(self):
+        index = self.repl.expect_loop(self.searcher)
+        input = self.in_flight.popleft()
+        output = self.repl.before
+        if self.echoes:
+            # The echo is the first line of the output.
+            output = output.lstrip("\r\n").partition("\n")[2]
+        result = self._result(input, index, output)
+        if result.is_timeout or result.is_eof:
+            self.in_flight.clear()
+        elif result.is_error:
+            self.pipeline = 1
+            self.drain()
+        return result
+
+    def drain(self):
+        """Read (and drop) the results of the lines sent ahead."""
+        while self.in_flight and not self._receive().terminates:
+            pass
+
+    def correspond_batch(self, inputs):
+        """Evaluate several lines with a single write.
+
+        Each line is followed by the language's sentinel, which prints a
+        marker line, and the output is split back into a ReplResult per line
+        at the markers. Only lines that are complete statements on their
+        own can be batched. Returns the results up to the first that
+        terminates evaluation; the lines after it have run all the same.
+        Without a sentinel the lines are sent one at a time.
+        """
+        self.drain()
+        self._check_echo()
+        if not self.sentinel:
+            results = []
+            for input in inputs:
+                results.append(self.correspond(input))
+                if results[-1].terminates:
+                    break
+            return results
+        self.batches += 1
+        sent = []
+        markers = []
+        for n, input in enumerate(inputs):
+            if self.should_ignore(input):
+                markers.append(None)
+                continue
+            marker = "__worksheet_%d_%d__" % (self.batches, n)
+            sent += [re.sub("\t", " ", input).rstrip("\n"), self.sentinel.format(marker=marker)]
+            markers.append(marker)
+        last = [m for m in markers if m is not None]
+        if not last:
+            return [ReplResult() for input in inputs]
+        self.repl.send("\n".join(sent) + "\n")
+        # A marker can come after prompts on its line, when the terminal
+        # echoed the whole batch up front.
+        prompts = "(?:%s)" % "|".join("(?:%s)" % p.pattern for p in self.prompt[2:])
+        end = searcher_re(self.prompt[:2] + [re.compile("(?m)^%s*%s\r?\n" % (prompts, last[-1]))])
+        index = self.repl.expect_loop(end)
+        output = self.repl.before
+        if index == 2:
+            index = self.repl.expect_loop(self.searcher)
+        if self.echoes or (self.strip_echo and not self.echo_off):
+            output = self._remove_echo(output, sent, prompts)
+        return self._split_batch(inputs, markers, output, index, prompts)
+
+    def _remove_echo(self, output, sent, prompts):
+        # The echo of each line starts a line of the output, after any
+        # prompts or terminal escapes, in order and ahead of the line's
+        # output.
+        pos = 0
+        for line in sent:
+            found = re.compile("(?m)^(?:%s|\x1b\\[[0-9;]*[A-Za-z])*(%s)" % (
+                prompts, re.escape(line))).search(output, pos)
+            if found:
+                output = output[:found.start(1)] + output[found.end(1):]
+                pos = found.start(1)
+        return output
+
+    def _split_batch(self, inputs, markers, output, index, prompts):
+        strip_prompts = re.compile("(?m)^%s+" % prompts)
+        results = []
+        for input, marker in zip(inputs, markers):
+            if marker is None:
+                results.append(ReplResult())
+                continue
+            found = re.search("(?m)^%s*%s\r?$" % (prompts, marker), output)
+            if found:
+                before, output = output[:found.start()], output[found.end():]
+                result = self._result(input, 2, strip_prompts.sub("", before))
+            else:
+                # The batch stopped with EOF or a timeout in this line.
+                result = self._result(input, index, strip_prompts.sub("", output))
+            results.append(result)
+            if result.terminates or not found:
+                break
+        return results
+
+    def _result(self, input, index, output=None):
+        # output is the line's output with the echo taken out already; by
+        # default it is what came before the prompt.
         prefix = self.prefix
-        self.repl.send(re.sub("\t", " ", input))
-        index = self.repl.expect_list(self.prompt)
+        # The first prompt follows EOF and TIMEOUT; any other is a
+        # continuation prompt.
+        self.at_first_prompt = index == 2
         if self.prompt[index] == pexpect.TIMEOUT:
             # Timeout
+            self.timed_out = True
             return ReplResult(prefix + "Execution timed out.", is_timeout=True)
         else:
             # For multiline statements additional newline is needed. See #26 issue
@@ -104,18 +996,86 @@ class Repl():
             # Regular prompt - need to check for error
             result_list = [
                 prefix + line
-                for line in fix_text(self.repl.before).split("\n")
+                for line in fix_text(self.repl.before if output is None else output).split("\n")
                 if len(line.strip())
             ]
-            if self.strip_echo:
+            if self.strip_echo and output is None:
                 result_list = result_list[start_index:]
             result_str = "\n".join(result_list)
             is_eof = self.prompt[index] == pexpect.EOF
             if is_eof:
                 result_str = "\n".join([result_str, prefix + " [exit]"])
+            is_error = self.is_error(result_str)
+            limit = self.limit_reached(result_str) if is_eof or is_error else None
+            if limit:
+                result_str = "\n".join(
+                    [result_str, prefix + "Execution stopped: %s limit reached." % limit])
             return ReplResult(result_str,
-                              is_error=self.is_error(result_str),
-                              is_eof=is_eof)
+                              is_error=is_error,
+                              is_eof=is_eof,
+                              is_limit=bool(limit))
+
+    def limit_reached(self, output):
+        """The resource limit ("CPU time", "memory" or "process count") the
+        REPL has run into, if any, going by its cgroup's events, the signal
+        that ended it or a limit_error in output."""
+        if self.cgroup is not None:
+            limit = self.cgroup.reached()
+            if limit:
+                return limit
+        if not self.rlimits:
+            return None
+        if [p for p in self.limit_error if p.search(output)]:
+            return "resource"
+        try:
+            if self.repl.isalive():
+                return None
+        except (pexpect.ExceptionPexpect, OSError):
+            return None
+        names = [name for name, soft, hard in self.rlimits]
+        sig = self.repl.signalstatus
+        if sig in (signal.SIGXCPU, signal.SIGKILL) and "RLIMIT_CPU" in names:
+            return "CPU time"
+        if sig in (signal.SIGSEGV, signal.SIGABRT) and "RLIMIT_AS" in names:
+            return "memory"
+        return None
+
+    def stats(self):
+        return {
+            "send_delay_saved": self.repl.delaysaved,
+            "reads": self.repl.readcount,
+            "bytes_read": self.repl.readbytes,
+            "uses": self.uses,
+            "startup": self.startup,
+            "closing": reaper.pending(),
+        }
+
+    def checkpoint(self):
+        """Snapshot the REPL's state, if it was started in a way that can.
+
+        Returns a checkpoint to pass back as the "resume" setting, which
+        starts a REPL in this state, or None. Checkpoints stay around until
+        discard_checkpoint() or until their fork server exits.
+        """
+        if not self.checkpoints or not self.at_first_prompt or self.in_flight:
+            return None
+        result = self.correspond("__worksheet_checkpoint__()\n")
+        match = re.search("checkpoint: (\\S+)", result.text)
+        return match and match.group(1)
+
+    def rss(self):
+        """The REPL process's resident memory in bytes, or None if it can't
+        be found out (only Linux has /proc/PID/status)."""
+        return _rss(self.repl.pid)
+
+    def age(self):
+        return time.time() - self.started
+
+    @property
+    def reusable(self):
+        # A REPL that timed out may still be busy with the line, so it can't
+        # be handed to the next run.
+        return not self.timed_out and self.repl.isalive()
 
     def should_ignore(self, str):
         return self._match_one(self.ignore, str)
@@ -129,6 +1089,10 @@ class Repl():
             regexes, False)
 
     def close(self, tries=0, max_retries=3):
+        if POSIX:
+            # Returns straight away; the reaper escalates from EOF to
+            # SIGKILL as needed.
+            return reaper.reap(self.repl, self.cgroup and self.cgroup.remove)
         try:
             # sometimes the process (*ahem* java) takes a little too long to
             # close, so take 3 tries.
@@ -143,3 +1107,50 @@ class Repl():
         except OSError as e:
             # Already closed - we're done.
             pass
+
+
+class AsyncRepl(Repl):
+    """A Repl driven by an asyncio event loop instead of a thread per line.
+
+    Nothing blocks: `ready` is a future for the REPL's first prompt (it
+    fails with ReplStartError), and correspond() returns a future for the
+    ReplResult. Calls to correspond() are queued behind each other, so a
+    worksheet can submit all of its lines up front. Use it from the loop's
+    thread only. Lines are sent one at a time, whatever pipeline and
+    batch_size say.
+    """
+    sends_ahead = False
+
+    def __init__(self, cmd, prompt, prefix, loop=None, **kwargs):
+        if asyncio is None or not POSIX:
+            raise ReplStartError("Asynchronous REPLs need Python 3.4+ and a pty")
+        self.loop = loop or asyncio.get_event_loop()
+        Repl.__init__(self, cmd, prompt, prefix, **kwargs)
+        self._last = self.ready
+
+    def _spawn(self, cmd, **kwargs):
+        kwargs.pop("backend", None)
+        if self.rlimits:
+            kwargs["preexec_fn"] = lambda: set_rlimits(self.rlimits)
+        return pexpect.aspawn(cmd, loop=self.loop, **kwargs)
+
+    def _wait_for_prompt(self, cmd):
+        self.ready = _then(self.loop, self.repl.expect_loop(self.searcher, self.startup_timeout),
+                           lambda index: self._started(index, cmd))
+
+    def correspond(self, input):
+        def start(_):
+            if self.should_ignore(input):
+                return ReplResult()
+            sent = _then(self.loop, self.ready,
+                         lambda _: self.repl.send(re.sub("\t", " ", input)))
+            index = _then(self.loop, sent,
+                          lambda _: self.repl.expect_loop(self.searcher))
+            return _then(self.loop, index, lambda i: self._result(input, i))
+        self._last = _then(self.loop, self._last, start, settled=True)
+        return self._last
+
+    def close(self, tries=0, max_retries=3):
+        # The reaper works in its own thread, away from the loop.
+        self.repl.detach()
+        Repl.close(self, tries, max_retries)
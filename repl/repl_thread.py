@@ -1,12 +1,156 @@
 import threading
+import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-class ReplThread(threading.Thread):
-    def __init__(self, repl, str):
+from .repl import ReplResult
+from .repl import ReplStartError
+from .repl import ReplStartCancelled
+
+
+class ReplJob(object):
+    """A line to evaluate; run() evaluates it, in the calling thread.
+    callback, if given, is called with the job once it is done. If the REPL
+    fails with an exception (e.g. it died while pooled), run() raises it
+    again after the callback, and error is the exception and the last
+    result one that stops evaluation."""
+    def __init__(self, repl, str, checkpoint=False, ahead=(), callback=None):
         self.repl = repl
         self.str = str
+        self.ahead = ahead
+        self.take_checkpoint = checkpoint
+        self.checkpoint = None
         self.result = None
+        self.results = []
+        self.error = None
+        self.callback = callback
+
+    def run(self):
+        try:
+            if self.take_checkpoint:
+                self.checkpoint = self.repl.checkpoint()
+            self.results = self.correspond()
+            self.result = self.results[-1]
+        except Exception as e:
+            self.error = e
+            self.result = ReplResult(self.repl.prefix + "Execution failed: %s" % e, is_eof=True)
+            self.results.append(self.result)
+            raise
+        finally:
+            if self.callback is not None:
+                self.callback(self)
+
+    def correspond(self):
+        return [self.repl.correspond(self.str, self.ahead)]
+
+
+class ReplBatchJob(ReplJob):
+    """Evaluates a list of lines with one Repl.correspond_batch() call;
+    results has one ReplResult per line evaluated."""
+    def correspond(self):
+        return self.repl.correspond_batch(self.str)
+
+
+class ReplWorker(threading.Thread):
+    """Runs ReplJobs one at a time, in the order they are submitted, on one
+    long-lived thread, instead of a thread per line.
+
+    submit() blocks while maxsize jobs are waiting (if maxsize is above
+    0). cancel() drops the jobs that haven't started, and returns them.
+    stop() ends the thread once the jobs submitted before it are done.
+    """
+    def __init__(self, maxsize=0):
+        self.jobs = queue.Queue(maxsize)
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def cancel(self):
+        dropped = []
+        while True:
+            try:
+                dropped.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+            self.jobs.task_done()
+        if None in dropped:
+            self.stop()
+        return [job for job in dropped if job is not None]
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                job.run()
+            except Exception:
+                # Keep going for the next job; the one that failed has had
+                # its callback.
+                traceback.print_exc()
+            finally:
+                self.jobs.task_done()
+
+
+class ReplStartThread(threading.Thread):
+    """Gets a REPL from pool in the background, so a slow interpreter
+    doesn't hold up the caller. When it is done, repl is the REPL, or error
+    the ReplStartError it failed with. resumed is whether the REPL carries
+    on from the checkpoint asked for; if that fails a new REPL is started
+    instead.
+
+    cancel() stops a start that is still going; a REPL that comes up
+    anyway is given back to the pool. callback is as for ReplJob."""
+    def __init__(self, pool, language, repl_def, resume=None, callback=None):
+        self.pool = pool
+        self.language = language
+        self.repl_def = repl_def
+        self.resume = resume
+        self.resumed = False
+        self.repl = None
+        self.error = None
+        self.cancelled = threading.Event()
+        self.callback = callback
         threading.Thread.__init__(self)
+        self.daemon = True
 
     def run(self):
-        self.result = self.repl.correspond(self.str)
+        try:
+            self.start_repl()
+        finally:
+            if self.callback is not None:
+                self.callback(self)
+
+    def start_repl(self):
+        try:
+            self.repl = self.acquire(self.resume)
+            self.resumed = self.resume is not None
+        except ReplStartError as e:
+            if self.resume is None or self.cancelled.is_set():
+                self.error = e
+                return
+            # The checkpoint has gone, e.g. with its fork server.
+            try:
+                self.repl = self.acquire(None)
+            except ReplStartError as e:
+                self.error = e
+                return
+        if self.cancelled.is_set():
+            self.pool.release(self.repl)
+            self.repl = None
+            self.error = ReplStartCancelled("Cancelled starting the REPL")
+
+    def acquire(self, resume):
+        return self.pool.acquire(self.language, dict(self.repl_def), resume=resume,
+                                 cancel=self.cancelled)
+
+    def cancel(self):
+        self.cancelled.set()
@@ -99,7 +99,8 @@ class winspawn(spawn):
     """This is the main class interface for Pexpect. Use this class to start
     and control child applications."""
     def __init__(self, command, args=[], timeout=30, maxread=2000, searchwindowsize=None,
-                 logfile=None, cwd=None, env=None, encoding='utf-8'):
+                 logfile=None, cwd=None, env=None, encoding='utf-8', backend='select'):
+        # The reader thread feeds a queue, so there is only one I/O backend.
         self.reader_queue = Queue()
         super(winspawn, self).__init__(command, args, timeout=timeout, maxread=maxread,
                                        searchwindowsize=searchwindowsize, logfile=logfile,
@@ -266,6 +267,7 @@ class winspawn(spawn):
                     break
                 if len(s) == size:
                     break
+        self._note_read(size, len(s))
 
         s2 = self._cast_buffer_type(s)
         if self.logfile is not None:
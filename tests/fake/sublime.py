@@ -0,0 +1,254 @@
+"""Stand-in for the parts of Sublime Text's sublime module that the plugin
+uses, so worksheet.py can be driven from tests. Timeouts only run from
+run_timeouts(); regions move with edits as in the editor."""
+import json
+import os
+import re
+import threading
+import time
+
+settings_path = None
+cache_directory = None
+_timeouts = []
+_settings = {}
+_lock = threading.Lock()
+_active = []
+
+HIDDEN = 128
+LAYOUT_INLINE, LAYOUT_BELOW, LAYOUT_BLOCK = 0, 1, 2
+
+
+def platform():
+    return "linux"
+
+
+def cache_path():
+    return cache_directory
+
+
+def error_message(message):
+    errors.append(message)
+
+
+errors = []
+status_messages = []
+
+
+def status_message(message):
+    status_messages.append(message)
+
+
+def set_timeout(fn, ms):
+    with _lock:
+        _timeouts.append((time.time() + ms / 1000.0, fn, ms))
+
+
+def _busy_workers():
+    return [t for t in threading.enumerate()
+            if type(t).__module__.endswith("repl_thread") and t.is_alive() and
+            (not hasattr(t, "jobs") or t.jobs.unfinished_tasks)]
+
+
+def run_timeouts(limit=60):
+    """Run timeouts as they come due until nothing is left to wait for.
+    Timeouts of a second or more (progress, idle timeouts) and phantom polls
+    don't keep this going by themselves."""
+    end = time.time() + limit
+    while time.time() < end:
+        with _lock:
+            due = sorted(_timeouts, key=lambda t: t[0])
+            now = due and due[0][0] <= time.time()
+            if now:
+                _timeouts.remove(due[0])
+            waiting = [t for t in _timeouts
+                       if t[2] < 1000 and getattr(t[1], "__name__", None) != "poll"]
+        if now:
+            due[0][1]()
+        elif waiting or _busy_workers():
+            time.sleep(0.0005)
+        else:
+            break
+
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def load_settings(name):
+    if name not in _settings:
+        with open(settings_path) as f:
+            _settings[name] = Settings(json.load(f))
+    return _settings[name]
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+    def __repr__(self):
+        return "Region(%d, %d)" % (self.a, self.b)
+
+
+def active_window():
+    return _active[-1] if _active else None
+
+
+class Window(object):
+    def __init__(self):
+        self.view = None
+        _active.append(self)
+
+    def focus(self):
+        _active.remove(self)
+        _active.append(self)
+
+    def active_view(self):
+        return self.view
+
+
+class View(object):
+    ids = 0
+
+    def __init__(self, text, syntax="Packages/Python/Python.tmLanguage", window=None):
+        View.ids += 1
+        self.view_id = View.ids
+        self.text = text
+        self.syntax = Settings(syntax=syntax)
+        self.status = {}
+        self.regions = {}
+        self.changes = 0
+        self.commands = []
+        self.phantom_sets = []
+        self.visible = None
+        self.closed = False
+        self.win = window or Window()
+        self.win.view = self
+
+    def id(self):
+        return self.view_id
+
+    def settings(self):
+        return self.syntax
+
+    def window(self):
+        return self.win
+
+    def file_name(self):
+        return None
+
+    def is_valid(self):
+        return not self.closed
+
+    def change_count(self):
+        return self.changes
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        if isinstance(region, Region):
+            return self.text[region.begin():region.end()]
+        return self.text[region]
+
+    def line(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        begin = self.text.rfind("\n", 0, point) + 1
+        end = self.text.find("\n", point)
+        return Region(begin, len(self.text) if end < 0 else end)
+
+    def full_line(self, point):
+        line = self.line(point)
+        return Region(line.a, min(line.b + 1, len(self.text)))
+
+    def lines(self, region):
+        lines, point = [], region.begin()
+        while True:
+            line = self.line(point)
+            lines.append(line)
+            if line.b >= region.end() or line.b >= len(self.text):
+                return lines
+            point = line.b + 1
+
+    def find_all(self, pattern):
+        return [Region(m.start(), m.end()) for m in re.finditer(pattern, self.text, re.M)]
+
+    def visible_region(self):
+        return Region(0, len(self.text)) if self.visible is None else Region(*self.visible)
+
+    def _move(self, move):
+        for key, regions in self.regions.items():
+            self.regions[key] = [Region(move(r.begin(), True), move(r.end(), False))
+                                 for r in regions]
+
+    def insert(self, edit, point, text):
+        # Text inserted at a region's end joins it, as the worst case.
+        self.changes += 1
+        self.text = self.text[:point] + text + self.text[point:]
+        self._move(lambda x, begin: x + len(text) if x > point or (x == point and begin) else x)
+        return len(text)
+
+    def erase(self, edit, region):
+        a, b = region.begin(), region.end()
+        self.changes += 1
+        self.text = self.text[:a] + self.text[b:]
+        self._move(lambda x, begin: x - (b - a) if x >= b else min(x, a))
+
+    def replace(self, edit, region, text):
+        self.erase(edit, region)
+        self.insert(edit, region.begin(), text)
+
+    def add_regions(self, key, regions, *args):
+        self.regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self.regions.get(key, []))
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def set_status(self, key, message):
+        self.status[key] = message
+
+    def run_command(self, name, args=None):
+        import sublime_plugin
+        self.commands.append(name)
+        if name in sublime_plugin.commands:
+            sublime_plugin.commands[name](self).run(None, **(args or {}))
+
+
+class Phantom(object):
+    def __init__(self, region, content, layout, on_navigate=None):
+        self.region = region
+        self.content = content
+        self.layout = layout
+
+
+class PhantomSet(object):
+    def __init__(self, view, key=""):
+        self.view = view
+        self.key = key
+        self.phantoms = []
+        self.updates = 0
+        view.phantom_sets.append(self)
+
+    def update(self, phantoms):
+        self.phantoms = list(phantoms)
+        self.updates += 1
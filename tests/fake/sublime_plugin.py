@@ -0,0 +1,24 @@
+"""Stand-in for Sublime Text's sublime_plugin module; see sublime.py."""
+import re
+
+commands = {}
+
+
+def command_name(cls):
+    name = re.sub("Command$", "", cls.__name__)
+    return re.sub("(?<!^)([A-Z])", "_\\1", name).lower()
+
+
+class CommandType(type):
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        commands[command_name(cls)] = cls
+
+
+class TextCommand(CommandType("TextCommandBase", (object,), {})):
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener(object):
+    pass
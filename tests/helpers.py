@@ -0,0 +1,60 @@
+"""Loads worksheet.py against the stand-in sublime module in tests/fake,
+with the Python REPL set up to run the interpreter running the tests."""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+
+sys.path.insert(0, os.path.join(TESTS, "fake"))
+sys.path.insert(0, os.path.dirname(ROOT))
+
+import sublime  # noqa: E402
+
+sublime.settings_path = os.path.join(ROOT, "worksheet.sublime-settings")
+sublime.cache_directory = tempfile.mkdtemp(prefix="worksheet-tests-")
+worksheet = importlib.import_module(os.path.basename(ROOT) + ".worksheet")
+repl = worksheet.repl
+
+PYTHON = '"%s" -i' % sys.executable
+
+
+def settings(**defaults):
+    """Reset the settings to the shipped ones, with worksheet_defaults
+    overridden by defaults."""
+    sublime._settings.clear()
+    loaded = sublime.load_settings("worksheet.sublime-settings")
+    python = loaded["worksheet_languages"]["Python"]
+    python["cmd"] = PYTHON
+    python["zygote"] = '"%s" "{repl_base}/python/zygote.py"' % sys.executable
+    loaded["worksheet_defaults"].update(defaults)
+    return loaded
+
+
+def evaluate(view, command="worksheet_eval"):
+    commands = {"worksheet_eval": worksheet.WorksheetEvalCommand,
+                "worksheet_clear": worksheet.WorksheetClearCommand}
+    commands[command](view).run(None)
+    sublime.run_timeouts()
+
+
+def python_def(**settings):
+    repl_def = {"cmd": PYTHON, "prompt": [">>> ", "\\.\\.+ "], "prefix": "# > ",
+                "error": ["Traceback "], "sentinel": "print('{marker}')"}
+    repl_def.update(settings)
+    return repl_def
+
+
+def clear_cache():
+    shutil.rmtree(sublime.cache_directory, True)
+
+
+def tear_down():
+    worksheet.plugin_unloaded()
+    sublime.errors[:] = []
+    sublime.status_messages[:] = []
+
+
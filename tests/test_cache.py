@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .helpers import repl
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        cache = repl.ResultCache(self.path, 1024 * 1024)
+        cache.put("a", repl.ReplResult("# > 1"))
+        cache.put("b", repl.ReplResult("# > oops", is_error=True))
+        cache.close()
+        cache = repl.ResultCache(self.path, 1024 * 1024)
+        self.assertEqual(str(cache.get("a")), "# > 1\n")
+        self.assertTrue(cache.get("b").is_error)
+        self.assertIsNone(cache.get("c"))
+
+    def test_uses_stay_within_max_size(self):
+        max_size = 2000
+        cache = repl.ResultCache(self.path, max_size)
+        for key in "abcde":
+            cache.put(key, repl.ReplResult("# > " + key * 40))
+        for i in range(1000):
+            self.assertIsNotNone(cache.get("abcde"[i % 5]))
+            self.assertLessEqual(cache.size, max_size)
+        cache.flush()
+        self.assertLessEqual(os.path.getsize(self.path), max_size)
+        # Compacting keeps the most recently used results.
+        for key in "bcde":
+            cache.get(key)
+        cache.max_size = 2 * sum(cache.entries[key][0] for key in "bcde")
+        cache.compact()
+        reloaded = repl.ResultCache(self.path, cache.max_size)
+        self.assertEqual(sorted(reloaded.entries), ["b", "c", "d", "e"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .helpers import repl, python_def, settings
+
+
+class DeadRepl(object):
+    prefix = "# > "
+
+    def correspond(self, input, ahead=()):
+        raise OSError("the REPL has gone")
+
+
+class ReplJobTest(unittest.TestCase):
+    def test_failing_job_gets_a_terminating_result(self):
+        done = threading.Event()
+        jobs = []
+        job = repl.ReplJob(DeadRepl(), "x\n", callback=lambda job: (jobs.append(job), done.set()))
+        worker = repl.ReplWorker()
+        worker.start()
+        worker.submit(job)
+        self.assertTrue(done.wait(5))
+        worker.stop()
+        self.assertEqual(jobs, [job])
+        self.assertIsInstance(job.error, OSError)
+        self.assertEqual(len(job.results), 1)
+        self.assertTrue(job.results[-1].terminates)
+        self.assertEqual(str(job.results[-1]), "# > Execution failed: the REPL has gone\n")
+
+
+class GetReplTest(unittest.TestCase):
+    def test_shipped_settings_are_accepted(self):
+        loaded = settings()
+        repl_def = dict(loaded["worksheet_defaults"])
+        repl_def.update(loaded["worksheet_languages"]["Python"])
+        r = repl.get_repl("Python", dict(repl_def))
+        try:
+            self.assertEqual(str(r.correspond("6 * 7\n")), "# > 42\n")
+        finally:
+            r.close()
+        loop = asyncio.new_event_loop()
+        r = repl.get_async_repl("Python", dict(repl_def), loop)
+        try:
+            loop.run_until_complete(r.ready)
+            self.assertEqual(str(loop.run_until_complete(r.correspond("6 * 7\n"))), "# > 42\n")
+        finally:
+            r.close()
+            loop.close()
+
+
+@unittest.skipUnless(repl.repl.Zygote.supported, "needs a fork server")
+class ZygoteTest(unittest.TestCase):
+    def start(self, seconds, **settings):
+        # A fork server whose module takes seconds to import.
+        modules = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, modules, True)
+        self.addCleanup(repl.close_zygotes)
+        with open(os.path.join(modules, "worksheet_slow.py"), "w") as f:
+            f.write("import time\ntime.sleep(%s)\n" % seconds)
+        return repl.Repl(**python_def(
+            start_mode="zygote", zygote='"%s" "{repl_base}/python/zygote.py"' % sys.executable,
+            zygote_modules=["worksheet_slow"], env=dict(os.environ, PYTHONPATH=modules),
+            **settings))
+
+    def test_fork_server_gets_the_startup_timeout(self):
+        r = self.start(1.5, timeout=1, startup_timeout=10)
+        try:
+            self.assertEqual(str(r.correspond("6 * 7\n")), "# > 42\n")
+        finally:
+            r.close()
+
+    def test_starting_fork_server_can_be_cancelled(self):
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        started = time.time()
+        self.assertRaises(repl.ReplStartCancelled, self.start, 10, startup_timeout=30,
+                          cancel=cancel)
+        self.assertLess(time.time() - started, 5)
+
+
+class EchoTest(unittest.TestCase):
+    def test_pipelined_repl_starts_without_echo(self):
+        # Turning the echo off from this side would race with the REPL
+        # reading its first line.
+        with mock.patch.object(repl.pexpect.spawn, "setecho") as setecho:
+            r = repl.Repl(**python_def(pipeline=2))
+        try:
+            self.assertFalse(setecho.called)
+            self.assertFalse(r.repl.getecho())
+            self.assertEqual(str(r.correspond("6 * 7\n", ["x = 1\n"])), "# > 42\n")
+            self.assertEqual(str(r.correspond("x = 1\n")), "")
+        finally:
+            r.close()
+
+
+class LimitsTest(unittest.TestCase):
+    def address_space(self, **settings):
+        r = repl.Repl(**python_def(limit_memory=512, **settings))
+        try:
+            r.correspond("import resource\n")
+            return str(r.correspond("resource.getrlimit(resource.RLIMIT_AS)[0] >> 20\n"))
+        finally:
+            r.close()
+
+    def test_cgroup_caps_memory_instead_of_address_space(self):
+        # A plain directory takes the cgroup's files just as well.
+        parent = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent, True)
+        self.assertEqual(self.address_space(), "# > 512\n")
+        self.assertEqual(self.address_space(cgroup=parent), "# > %d\n" % (
+            resource.getrlimit(resource.RLIMIT_AS)[0] >> 20))
+        [cgroup] = os.listdir(parent)
+        with open(os.path.join(parent, cgroup, "memory.max")) as f:
+            self.assertEqual(f.read(), str(512 * 1024 * 1024))
+
+    @unittest.skipUnless(hasattr(resource, "prlimit"), "needs prlimit")
+    def test_address_space_is_limited_without_the_cgroup(self):
+        self.assertEqual(self.address_space(cgroup="/nonexistent/cgroup"), "# > 512\n")
+
+
+class AsyncReplTest(unittest.TestCase):
+    def test_detached_repl_sends_from_any_thread(self):
+        loop = asyncio.new_event_loop()
+        r = repl.AsyncRepl(loop=loop, **python_def())
+        loop.run_until_complete(r.ready)
+        r.repl.detach()
+        loop.close()
+        # As the reaper does, once the loop has let the REPL go.
+        done = []
+        thread = threading.Thread(target=lambda: done.append(r.repl.sendeof()))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(done, [None])
+        r.close()
+
+    def test_limits_are_set(self):
+        loop = asyncio.new_event_loop()
+        r = repl.AsyncRepl(loop=loop, **python_def(limit_cpu=30))
+        try:
+            loop.run_until_complete(r.ready)
+            r.correspond("import resource\n")
+            result = loop.run_until_complete(
+                r.correspond("resource.getrlimit(resource.RLIMIT_CPU)\n"))
+            self.assertEqual(str(result), "# > (30, 31)\n")
+        finally:
+            r.close()
+            loop.close()
+
+    def test_pipeline_keeps_the_echo(self):
+        # Lines are sent one at a time, so the echo is there to strip.
+        loop = asyncio.new_event_loop()
+        r = repl.AsyncRepl(loop=loop, **python_def(pipeline=2))
+        try:
+            loop.run_until_complete(r.ready)
+            result = loop.run_until_complete(r.correspond("print('a'); print('b')\n"))
+            self.assertEqual(str(result), "# > a\n# > b\n")
+        finally:
+            r.close()
+            loop.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .helpers import sublime, worksheet, repl, settings, evaluate, python_def, clear_cache, \
+    tear_down
+
+
+class SettingsTest(unittest.TestCase):
+    def test_pipeline_is_only_set_per_language(self):
+        loaded = settings(pipeline=4)
+        view = sublime.View("")
+        self.assertNotIn("pipeline", worksheet.get_repl_def(view, loaded, {})[1])
+        loaded["worksheet_languages"]["Python"]["pipeline"] = 2
+        self.assertEqual(worksheet.get_repl_def(view, loaded, {})[1]["pipeline"], 2)
+
+
+class PoolTest(unittest.TestCase):
+    def tearDown(self):
+        tear_down()
+
+    def test_expire_evicts_and_reports(self):
+        pool = repl.pool
+        kept = [repl.Repl(**python_def()) for n in range(2)]
+        pool.idle["test"] = list(kept)
+        self.addCleanup(setattr, pool, "max_count", pool.max_count)
+        pool.max_count = 1
+        pool.expire(60)
+        sublime.run_timeouts()
+        self.assertEqual(pool.idle["test"], [kept[1]])
+        self.assertEqual(sublime.errors, [])
+        self.assertEqual(len(sublime.status_messages), 1)
+        self.assertIn("Closed REPL process %s" % kept[0].repl.pid, sublime.status_messages[0])
+        self.assertIn("more than 1 REPLs kept", sublime.status_messages[0])
+
+
+class ResultsTest(unittest.TestCase):
+    def tearDown(self):
+        tear_down()
+
+    def test_user_comment_with_prefix_is_source(self):
+        settings(reuse="keep", deterministic=True)
+        clear_cache()
+        view = sublime.View("x = 1\nx\n")
+        evaluate(view)
+        # A comment of the user's that looks like a result, once results
+        # are tracked, stays and is evaluated like any other line.
+        view.insert(None, 0, "# > note\n")
+        evaluate(view)
+        self.assertEqual(view.text, "# > note\nx = 1\nx\n# > 1\n")
+        source = worksheet.get_source(view, "# > ")
+        self.assertEqual([text for offset, text in source], ["# > note", "x = 1", "x", ""])
+        # Carrying on in the kept REPL puts the new result below its line.
+        view.insert(None, view.size(), "x + 1\n")
+        evaluate(view)
+        self.assertEqual(view.text, "# > note\nx = 1\nx\n# > 1\nx + 1\n# > 2\n")
+        self.assertIn("REPL reused", view.status["worksheet_stats"])
+        # And so does filling in results from the cache.
+        evaluate(view, "worksheet_clear")
+        evaluate(view)
+        self.assertEqual(view.status["worksheet_stats"], "Worksheet: 4 results from the cache")
+        self.assertEqual(view.text, "# > note\nx = 1\nx\n# > 1\nx + 1\n# > 2\n")
+
+    def erase_results(self, view):
+        for region in reversed(view.get_regions("worksheet_results")):
+            view.erase(None, view.full_line(region))
+
+    def test_undone_results_are_evaluated_again(self):
+        settings(reuse="keep")
+        view = sublime.View("x = 1\nx\n")
+        evaluate(view)
+        self.erase_results(view)
+        worksheet.WorksheetResultsListener().on_post_text_command(view, "undo", None)
+        view.insert(None, view.size(), "x + 1\n")
+        evaluate(view)
+        self.assertEqual(view.text, "x = 1\nx\n# > 1\nx + 1\n# > 2\n")
+
+    def test_erased_results_are_evaluated_again(self):
+        settings(reuse="keep")
+        view = sublime.View("x = 1\nx\ny = 2\ny\n")
+        evaluate(view)
+        # Results erased by hand leave their regions empty.
+        view.erase(None, view.full_line(view.get_regions("worksheet_results")[-1]))
+        view.insert(None, view.size(), "x + y\n")
+        evaluate(view)
+        self.assertEqual(view.text, "x = 1\nx\n# > 1\ny = 2\ny\n# > 2\nx + y\n# > 3\n")
+
+    @unittest.skipUnless(repl.repl.Zygote.supported, "needs a fork server")
+    def test_checkpoint_is_not_resumed_after_undo(self):
+        settings(start_mode="zygote", checkpoint_interval=2)
+        view = sublime.View("a = 1\na\nb = 3\nb\na + b\n")
+        evaluate(view)
+        self.assertEqual(view.text, "a = 1\na\n# > 1\nb = 3\nb\n# > 3\na + b\n# > 4\n")
+        self.erase_results(view)
+        view.replace(None, view.full_line(view.size() - 1), "a * b\n")
+        evaluate(view)
+        self.assertEqual(view.text, "a = 1\na\n# > 1\nb = 3\nb\n# > 3\na * b\n# > 3\n")
+
+    def test_repl_failing_stops_evaluation(self):
+        settings()
+        view = sublime.View("x = 1\nx\n")
+        with mock.patch.object(worksheet.repl.Repl, "correspond",
+                               side_effect=OSError("the REPL has gone")):
+            evaluate(view)
+        self.assertEqual(view.text, "x = 1\n# > Execution failed: the REPL has gone\nx\n")
+        self.assertEqual(view.status["worksheet"], "")
+        self.assertIn("REPL started", view.status["worksheet_stats"])
+
+
+class PhantomsTest(unittest.TestCase):
+    def tearDown(self):
+        tear_down()
+
+    def test_only_the_focused_view_polls(self):
+        settings()
+        sublime.load_settings("worksheet.sublime-settings")["worksheet_render"] = "phantoms"
+        view = sublime.View("x = 6\nx * 7\n")
+        evaluate(view)
+        phantoms = worksheet.view_phantoms[view.id()]
+        self.assertTrue(phantoms.polling)
+        sublime.View("")
+        phantoms.poll()
+        self.assertFalse(phantoms.polling)
+        listener = worksheet.WorksheetPhantomsListener()
+        view.win.focus()
+        listener.on_activated(view)
+        self.assertTrue(phantoms.polling)
+
+    def test_phantoms_leave_the_text_alone(self):
+        settings()
+        sublime.load_settings("worksheet.sublime-settings")["worksheet_render"] = "phantoms"
+        source = "# > an old result\nx = 6\nx * 7"
+        view = sublime.View(source)
+        evaluate(view)
+        self.assertEqual(view.text, source)
+        self.assertEqual(view.change_count(), 0)
+        phantoms = view.phantom_sets[0].phantoms
+        self.assertEqual(len(phantoms), 1)
+        self.assertEqual(phantoms[0].region, sublime.Region(view.size()))
+        self.assertIn(">42<", phantoms[0].content)
+        # Evaluating again replaces the phantoms, still without edits.
+        evaluate(view)
+        self.assertEqual(view.change_count(), 0)
+        self.assertEqual(len(view.phantom_sets[0].phantoms), 1)
+        # Clearing removes the results written as text too.
+        evaluate(view, "worksheet_clear")
+        self.assertEqual(view.text, "x = 6\nx * 7")
+        self.assertEqual(view.phantom_sets[0].phantoms, [])
+
+
+class BatchTest(unittest.TestCase):
+    source = "\n".join([
+        "for i in range(2): print(i)",
+        "",
+        "x = 7",
+        "if x: y = 1",
+        "else: y = 2",
+        "",
+        "y",
+        "def dec(f): return f",
+        "",
+        "@dec",
+        "def g(): return 3",
+        "",
+        "g()",
+        "d = {1: 'a:b'}; f = lambda v: v",
+        "d[1], f(x)",
+        "x",
+        "z = (1 +",
+        "2)",
+        "z",
+        "s = '''a",
+        "b'''",
+        "s",
+        ""])
+
+    def tearDown(self):
+        tear_down()
+
+    def evaluate(self, **defaults):
+        settings(**defaults)
+        view = sublime.View(self.source)
+        evaluate(view)
+        return view.text
+
+    def test_compound_statements_are_not_batched(self):
+        self.assertFalse(worksheet.batchable("for i in range(2): print(i)", "", True))
+        self.assertFalse(worksheet.batchable("else: y = 2", "", True))
+        self.assertFalse(worksheet.batchable("@dec", "def g(): return 3", True))
+        self.assertFalse(worksheet.batchable("f = lambda v: v", "", True))
+        self.assertTrue(worksheet.batchable("d = {1: 'a:b'}  # a: comment", "", True))
+        self.assertTrue(worksheet.batchable("", "x"))
+
+    def test_open_brackets_and_strings_are_not_batched(self):
+        self.assertFalse(worksheet.batchable("z = (1 +", "2)"))
+        self.assertFalse(worksheet.batchable("2)", "z"))
+        self.assertFalse(worksheet.batchable("s = '''a", "b'''"))
+        self.assertTrue(worksheet.batchable("s = '''a'''  # don't", "s", True))
+
+    def test_python_rules_are_only_for_python(self):
+        self.assertFalse(worksheet.batchable("if x: y = 1", "", True))
+        self.assertTrue(worksheet.batchable("x = c ? 1 : 2;", ""))
+        self.assertFalse(worksheet.batchable("f({", "a: 1})"))
+
+    def test_batches_give_the_same_results(self):
+        lockstep = self.evaluate()
+        self.assertIn("# > 0\n# > 1\n", lockstep)
+        self.assertTrue(lockstep.endswith("s\n# > 'a\\nb'\n"), lockstep)
+        self.assertIn("z\n# > 3\n", lockstep)
+        self.assertEqual(self.evaluate(batch_size=10), lockstep)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 import sublime
 import sublime_plugin
 import os
+import json
+import time
+import hashlib
 from sys import version_info
 PY3K = version_info >= (3, 0, 0)
 if PY3K:
@@ -18,114 +21,876 @@ if sublime.platform() != 'windows':
         os.environ["PATH"] = os.pathsep.join(exec_path + ["/usr/local/bin"])
 
 
+def get_language(view):
+    return view.settings().get("syntax").split('/')[-1].split('.')[0]
+
+
+# Settings that only take effect for the language they are set for.
+language_settings = ("pipeline",)
+
+
+def get_repl_def(view, settings, project_settings):
+    language = get_language(view)
+    default_def = [(key, setting) for key, setting in get_repl_settings(settings, project_settings)
+                   if key not in language_settings]
+    repl_defs = settings.get("worksheet_languages")
+    project_repl_defs = project_settings.get("worksheet_languages", {})
+    repl_def = dict(
+        list(default_def) + list(project_repl_defs.get(language, repl_defs.get(language, {})).items()))
+    filename = view.file_name()
+    if filename is not None:
+        repl_def["cwd"] = os.path.dirname(filename)
+    return language, repl_def
+
+
+def get_repl_settings(settings, project_settings):
+    default_def = settings.get("worksheet_defaults")
+    project_def = project_settings.get("worksheet_defaults", {})
+    repl_settings = []
+    for key, setting in default_def.items():
+        repl_settings.append((key, project_def.get(key, setting)))
+    return repl_settings
+
+
+def get_source(view, prefix, phantoms=False):
+    """The worksheet's lines, leaving out results, with their offsets. These
+    are the lines evaluation goes through: results are the lines
+    remove_previous_results() would erase, i.e. those starting with the
+    prefix in a tracked result region, or any starting with the prefix if
+    the view's results aren't tracked. Evaluating with phantoms leaves the
+    text alone, so then every line is source."""
+    if phantoms:
+        text = view.substr(sublime.Region(0, view.size()))
+        source = []
+        offset = 0
+        for line in text.split("\n"):
+            source.append((offset, line))
+            offset += len(line) + 1
+        return source
+    tracked = view.id() in tracked_views
+    results = sorted(view.get_regions("worksheet_results"), key=lambda r: r.begin()) \
+        if tracked else []
+    source = []
+    offset = 0
+    index = 0
+    for line in view.substr(sublime.Region(0, view.size())).split("\n"):
+        while index < len(results) and results[index].end() < offset:
+            index += 1
+        in_result = not tracked or (index < len(results) and results[index].begin() <= offset)
+        if not (in_result and line.startswith(prefix)):
+            source.append((offset, line))
+        offset += len(line) + 1
+    return source
+
+
+# Python lines starting with these open a block, even with its body on the
+# same line, so the sentinel can't follow them directly.
+compound_keywords = ("if", "elif", "else", "for", "while", "try", "except", "finally",
+                     "with", "def", "class", "async", "match", "case")
+
+
+def scan_line(line, comment=None):
+    # The bracket depth and the open quote (or None) at the end of line, and
+    # whether it has a ":" outside brackets and strings, as a one-line Python
+    # compound statement (or a lambda or annotation) does. Scanning stops
+    # at comment. A triple quote counts as three quotes, so a line that
+    # opens a triple-quoted string ends inside a string too.
+    depth = 0
+    quote = None
+    escaped = False
+    colon = False
+    for n, char in enumerate(line):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif comment and line.startswith(comment, n):
+            break
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == ":" and depth <= 0:
+            colon = True
+    return depth, quote, colon
+
+
+def batchable(line, next_line, python=False):
+    # Whether line is a statement on its own: not part of a block, not
+    # opening one and not continued on the next line. Only Python's block
+    # syntax is known; for other languages lines are batched as long as
+    # they close their brackets and strings and aren't indented.
+    indent = (" ", "\t")
+    if line.startswith(indent) or next_line.startswith(indent):
+        return False
+    if line.rstrip().endswith((",", "\\", "(", "[", "{")):
+        return False
+    depth, quote, colon = scan_line(line, "#" if python else None)
+    if depth != 0 or quote:
+        return False
+    if not python:
+        return True
+    words = line.split(None, 1)
+    if words and (words[0].rstrip(":") in compound_keywords or line.startswith("@")):
+        return False
+    return not line.rstrip().endswith(":") and not colon
+
+
+def prefix_hashes(lines, seed):
+    """Rolling hashes of the source: the i-th is of seed and lines 0..i, so
+    two sources agree up to line i exactly when their i-th hashes do."""
+    digest = hashlib.sha1(seed.encode("utf-8"))
+    hashes = []
+    for line in lines:
+        digest.update(line.encode("utf-8") + b"\n")
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+class History(object):
+    """What evaluating a view left behind: for each line evaluated, the hash
+    of the source up to it (see prefix_hashes()) and its result; the REPL
+    checkpoints taken, as (line, checkpoint) pairs where the checkpoint has
+    the state from before that line; and the REPL itself, if the pool kept
+    it with the state all those lines left."""
+    def __init__(self):
+        self.hashes = []
+        self.lines = []
+        self.points = []
+        self.repl = None
+        self.last_used = None
+
+    def resume_point(self, hashes, texts, shown=None):
+        """Forget what changes to the source since the last evaluation make
+        stale, and return the line to carry on from with the kept REPL or
+        checkpoint to do it with: (line, repl), (line, checkpoint) or
+        (0, None). shown is how many of the lines evaluated still have
+        their results in the view, if not all of them; the lines after
+        those count as changed."""
+        same = self.unchanged(hashes)
+        if shown is not None:
+            same = min(same, shown)
+        evaluated = len(self.lines)
+        kept, self.repl = self.repl, None
+        del self.lines[same:]
+        self.discard(same)
+        self.hashes = hashes
+        # A kept REPL has run every line evaluated, so it can only go on
+        # if none of them changed, and there are new lines for it.
+        if kept is not None and evaluated == same and \
+                any(text.strip() for text in texts[same:]) and \
+                repl.pool.reclaim(kept, self.last_used):
+            return same, kept
+        return self.points[-1] if self.points else (0, None)
+
+    def unchanged(self, hashes):
+        # How many lines evaluated are as they were. The hashes cover the
+        # whole prefix, so they match up to the first changed line and not
+        # after it.
+        low, high = 0, min(len(hashes), len(self.lines))
+        while low < high:
+            middle = (low + high) // 2
+            if self.lines[middle][0] == hashes[middle]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add(self, line, result):
+        del self.lines[line:]
+        if line < len(self.hashes):
+            self.lines.append((self.hashes[line], result))
+
+    def add_checkpoint(self, line, checkpoint):
+        self.points.append((line, checkpoint))
+
+    def keep(self, released):
+        """Remember released for the next evaluation if the pool kept it
+        and evaluation got through every line."""
+        if released.reuse == "keep" and self.lines and not self.lines[-1][1].terminates:
+            self.repl, self.last_used = released, released.last_used
+
+    def discard(self, after=-1):
+        for line, checkpoint in self.points:
+            if line > after:
+                repl.discard_checkpoint(checkpoint)
+        self.points = [(line, c) for line, c in self.points if line <= after]
+
+    def forget(self):
+        self.discard()
+        self.lines = []
+        self.repl = None
+
+
+view_histories = {}
+# The results shown as phantoms in each view.
+view_phantoms = {}
+# Results of deterministic worksheets, kept between sessions.
+result_cache = None
+# The REPL being started for each view, and the view's change count when
+# the start began.
+view_starts = {}
+# The worker thread evaluating each view's lines.
+view_workers = {}
+# The views whose results are all in their "worksheet_results" regions.
+# Regions don't outlast the view, nor the plugin, so neither does this.
+tracked_views = set()
+
+
+def escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+class ResultPhantoms(object):
+    """A view's results shown as phantoms below their lines, rather than
+    written into it. Each result is kept with a region for its line, which
+    moves as the view is edited, but only the results in or near the part
+    of the view that is visible get a phantom. Sublime Text has no event for
+    scrolling, so while the view is the one with focus the visible region is
+    checked every poll_interval ms, and the phantoms only change when it has
+    moved or the view has been edited. Other views are left alone until
+    they are edited or get focus again."""
+    key = "worksheet_phantoms"
+    poll_interval = 100
+    # Longer results only show their first lines.
+    max_lines = 50
+
+    def __init__(self, view, prefix):
+        self.view = view
+        self.prefix = prefix
+        self.phantom_set = sublime.PhantomSet(view, self.key)
+        self.texts = []
+        self.shown = None
+        self.polling = False
+
+    def add(self, results):
+        """Show results, (line region, text) pairs in order, which all come
+        after the results already shown."""
+        regions = self.regions()
+        for line, text in results:
+            regions.append(line)
+            self.texts.append(text)
+        self.view.add_regions(self.key, regions, "", "", sublime.HIDDEN)
+        self.refresh()
+        self.start_polling()
+
+    def remove(self, start=0):
+        """Stop showing the results of lines from start on."""
+        regions = self.regions()
+        kept = 0
+        while kept < len(regions) and regions[kept].begin() < start:
+            kept += 1
+        del self.texts[kept:]
+        self.view.add_regions(self.key, regions[:kept], "", "", sublime.HIDDEN)
+        self.refresh()
+
+    def regions(self):
+        regions = self.view.get_regions(self.key)
+        if len(regions) != len(self.texts):
+            # Deleting lines has merged some of them; which result goes
+            # with which line isn't known any more.
+            del self.texts[:]
+            return []
+        return regions
+
+    def refresh(self):
+        self.shown = None
+        self.render()
+
+    def render(self):
+        visible = self.view.visible_region()
+        state = (visible.begin(), visible.end(), self.view.change_count())
+        if state == self.shown:
+            return
+        self.shown = state
+        regions = self.regions()
+        # A screen's worth either side, so scrolling a little shows
+        # phantoms that are there already.
+        low, high = visible.begin() - visible.size(), visible.end() + visible.size()
+        first = 0
+        last = len(regions)
+        while first < last:
+            middle = (first + last) // 2
+            if regions[middle].end() < low:
+                first = middle + 1
+            else:
+                last = middle
+        phantoms = []
+        for region, text in zip(regions[first:], self.texts[first:]):
+            if region.begin() > high:
+                break
+            phantoms.append(sublime.Phantom(sublime.Region(region.end()), self.html(text),
+                                            sublime.LAYOUT_BLOCK))
+        self.phantom_set.update(phantoms)
+
+    def html(self, text):
+        lines = [line[len(self.prefix):] if line.startswith(self.prefix) else line
+                 for line in text.rstrip("\n").split("\n")]
+        if len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + ["... %d more lines" % (len(lines) - self.max_lines)]
+        return "<body id=\"worksheet-result\"><div>%s</div></body>" % "<br>".join(
+            escape_html(line).replace(" ", "&nbsp;") for line in lines)
+
+    def start_polling(self):
+        if not self.polling:
+            self.polling = True
+            sublime.set_timeout(self.poll, self.poll_interval)
+
+    def focused(self):
+        window = sublime.active_window()
+        active = window and window.active_view()
+        return active is not None and active.id() == self.view.id()
+
+    def poll(self):
+        if (not self.texts or not self.view.is_valid() or not self.focused() or
+                view_phantoms.get(self.view.id()) is not self):
+            self.polling = False
+            return
+        self.render()
+        sublime.set_timeout(self.poll, self.poll_interval)
+
+
+def report_eviction(message):
+    """Log why the pool closed a REPL to the console and the status bar; any
+    thread can call it."""
+    message = "Worksheet: " + message
+    print(message)
+    sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+
+repl.pool.report = report_eviction
+
+
+def cancel_start(view):
+    if view.id() in view_starts:
+        view_starts.pop(view.id())[0].cancel()
+
+
+def get_worker(view):
+    worker = view_workers.get(view.id())
+    if worker is None or not worker.is_alive():
+        worker = view_workers[view.id()] = repl.ReplWorker()
+        worker.start()
+    return worker
+
+
+def stop_worker(view_id):
+    if view_id in view_workers:
+        worker = view_workers.pop(view_id)
+        worker.cancel()
+        worker.stop()
+
+
+def get_result_cache(settings):
+    global result_cache
+    if result_cache is None:
+        if hasattr(sublime, "cache_path"):
+            directory = sublime.cache_path()
+        else:
+            # Sublime Text 2 has no cache directory.
+            directory = os.path.join(sublime.packages_path(), "User")
+        result_cache = repl.ResultCache(
+            os.path.join(directory, "Worksheet", "results.jsonl"),
+            settings.get("worksheet_cache_max_size") * 1024 * 1024)
+    return result_cache
+
+
 class WorksheetCommand(sublime_plugin.TextCommand):
+    # Results are put into the view at most every flush_interval ms, all
+    # that have come in since the last time in one edit.
+    flush_interval = 30
+
     def run(self, edit):
+        """Start the REPL in the background, then go on with started()."""
         self.load_settings()
-        try:
-            language = self.get_language()
-            default_def = self.get_repl_settings()
-            repl_defs = self.settings.get("worksheet_languages")
-            project_repl_defs = self.project_settings.get("worksheet_languages", {})
-            repl_def = dict(
-                list(default_def) + list(project_repl_defs.get(language, repl_defs.get(language, {})).items()))
-            filename = self.view.file_name()
-            if filename is not None:
-                repl_def["cwd"] = os.path.dirname(filename)
-            self.repl = repl.get_repl(language, repl_def)
-        except repl.ReplStartError as e:
-            return sublime.error_message(str(e))
-        self.remove_previous_results(edit)
+        language, repl_def = get_repl_def(self.view, self.settings, self.project_settings)
+        self.prefix = repl_def["prefix"]
+        self.cache = None
+        if repl_def.pop("deterministic", False):
+            self.cache = get_result_cache(self.settings)
+        self.read_source(language, repl_def)
+        cancel_start(self.view)
+        if self.cache is not None and self.fill_from_cache():
+            return
+        self.start, resume = self.resume_point(repl_def)
+        if isinstance(resume, repl.Repl):
+            # The REPL the last evaluation left, ready for the next line.
+            return self.begin(resume)
+        thread = repl.ReplStartThread(
+            repl.pool, language, repl_def, resume,
+            self.on_main_thread(lambda thread: self.handle_start(thread, resume)))
+        view_starts[self.view.id()] = (thread, self.view.change_count())
+        thread.start()
+        self.track(thread, "Starting %(language)s REPL")
+
+    def read_source(self, language, repl_def):
+        # The source lines with their offsets, and their prefix hashes, which
+        # key both the view's History and the result cache.
+        self.source = get_source(self.view, self.prefix, self.use_phantoms)
+        self.hashes = prefix_hashes([text for offset, text in self.source],
+                                    json.dumps([language, repl_def], sort_keys=True))
+
+    def fill_from_cache(self):
+        """Put in the results of the whole source from the cache, without a
+        REPL, if it has all of them. Returns whether it did."""
+        source, hashes = self.source, self.hashes
+        if not source[-1][1]:
+            # The end of a view ending in a newline isn't a line.
+            source, hashes = source[:-1], hashes[:-1]
+        if not hashes:
+            return False
+        results = []
+        for key in hashes:
+            result = self.cache.get(key)
+            if result is None:
+                return False
+            results.append(result)
+            if result.terminates:
+                break
+        self.begin_results()
+        self.remove_previous_results()
+        self.ensure_trailing_newline()
+        for (offset, text), result in zip(get_source(self.view, self.prefix, self.use_phantoms),
+                                        results):
+            self.insert(result, offset + len(text) + 1)
+        self.finish_results()
+        self.set_status("")
+        self.set_status("Worksheet: %d results from the cache" % len(results), "worksheet_stats")
+        return True
+
+    def on_main_thread(self, handler):
+        # A callback for a thread or job which has handler(task) called on
+        # the main thread once the task is done.
+        return lambda task: sublime.set_timeout(lambda: handler(task), 0)
+
+    def track(self, task, progress):
+        self.running = task
+        began = time.time()
+        sublime.set_timeout(lambda: self.show_progress(task, progress, began), 1000)
+
+    def show_progress(self, task, progress, began):
+        """Show how long task (a thread or job) has taken so far, once a
+        second until its handler has run."""
+        if self.running is task:
+            self.set_status(progress + " (%ds)." % (time.time() - began))
+            sublime.set_timeout(lambda: self.show_progress(task, progress, began), 1000)
+
+    def handle_start(self, thread, resume):
+        if self.running is thread:
+            self.running = None
+        if view_starts.get(self.view.id(), (None,))[0] is thread:
+            del view_starts[self.view.id()]
+        self.set_status("")
+        if thread.cancelled.is_set():
+            if thread.repl is not None:
+                repl.pool.release(thread.repl)
+            return
+        if thread.error is not None:
+            return sublime.error_message(str(thread.error))
+        if resume is not None and not thread.resumed:
+            self.history.forget()
+            self.line_number, self.start = 0, 0
+        self.begin(thread.repl)
+
+    def begin(self, started):
+        self.repl = started
+        self.set_status("", "worksheet_stats")
+        self.begin_results()
+        self.remove_previous_results(self.start)
+        self.started()
+
+    def started(self):
+        pass
+
+    def begin_results(self):
+        # Everything up to cleanup() is undone in one go.
+        self.view.run_command("mark_undo_groups_for_gluing")
+        self.pending = []
+        self.flush_queued = False
+        self.shifted = 0
+        self.results = 0
+        self.flushes = 0
+
+    def resume_point(self, repl_def):
+        """Work out where evaluation can start, returning the text offset and
+        the checkpoint or kept REPL to resume with (None to start a new
+        REPL)."""
+        self.history = view_histories.setdefault(self.view.id(), History())
+        self.line_number = 0
+        self.history.forget()
+        return 0, None
 
     def load_settings(self):
         self.settings = sublime.load_settings("worksheet.sublime-settings")
         self.timeout = self.settings.get("worksheet_timeout")
-
-    def get_repl_settings(self):
-        default_def = self.settings.get("worksheet_defaults")
+        # Phantoms are new in Sublime Text 3 (build 3118).
+        self.use_phantoms = self.settings.get("worksheet_render") == "phantoms" and \
+            hasattr(sublime, "PhantomSet")
         if not hasattr(self, "project_settings"):
             self.project_settings = {}
-        project_def = self.project_settings.get("worksheet_defaults", {})
-        settings = []
-        for key, setting in default_def.items():
-            settings.append((key, project_def.get(key, setting)))
-        return settings
 
     def get_language(self):
-        return self.view.settings().get("syntax").split('/')[-1].split('.')[0]
+        return get_language(self.view)
 
-    def remove_previous_results(self, edit):
-        if not PY3K:
-            edit = self.view.begin_edit("remove_previous_results")
-        for region in reversed(self.view.find_all("^" + self.repl.prefix)):
-            self.view.erase(edit, self.view.full_line(region))
-        if not PY3K:
-            self.view.end_edit(edit)
+    def remove_previous_results(self, start=0):
+        """Erase the results from start on. Results put in since the view
+        was opened are in regions; otherwise every line starting with the
+        prefix is taken for one. Results shown as phantoms go as well, and
+        in phantom mode only they do, so evaluating doesn't edit the text."""
+        self.remove_previous_phantoms(start)
+        if self.use_phantoms:
+            return
+        if self.view.id() not in tracked_views:
+            with Edit(self.view) as edit:
+                for region in reversed(self.view.find_all("^" + self.prefix)):
+                    if region.begin() < start:
+                        break
+                    edit.erase(self.view.full_line(region))
+            self.view.erase_regions("worksheet_results")
+            tracked_views.add(self.view.id())
+            return
+        regions = sorted(self.view.get_regions("worksheet_results"), key=lambda r: r.begin())
+        kept = [region for region in regions if region.begin() < start]
+        with Edit(self.view) as edit:
+            for region in reversed(regions[len(kept):]):
+                # Only the lines still starting with the prefix, in case
+                # something else has been typed into the result.
+                for line in reversed(self.view.lines(region)):
+                    if self.view.substr(line).startswith(self.prefix):
+                        edit.erase(self.view.full_line(line))
+        self.view.add_regions("worksheet_results", kept, "", "", sublime.HIDDEN)
+
+    def remove_previous_phantoms(self, start=0):
+        if self.view.id() in view_phantoms:
+            view_phantoms[self.view.id()].remove(start)
 
-    def ensure_trailing_newline(self, edit):
+    def ensure_trailing_newline(self):
+        if self.use_phantoms:
+            # process_line() sends the last line with a newline instead.
+            return
         eof = self.view.size()
         if len(self.view.substr(self.view.line(eof)).strip()) is not 0:
-            self.view.insert(edit, eof, "\n")
+            with Edit(self.view) as edit:
+                edit.insert(eof, "\n")
 
     def process_line(self, start):
         line = self.view.full_line(start)
         line_text = self.view.substr(line)
+        if self.use_phantoms and line.begin() == start and line_text.strip() and \
+                "\n" not in line_text:
+            # The last line, without a newline; its phantom goes at the end.
+            line_text += "\n"
         if "\n" in line_text:
-            self.view.add_regions("worksheet", list([line]), "string")
-            self.set_status("Sending 1 line to %(language)s REPL.")
-            self.queue_thread(
-                repl.ReplThread(self.repl, line_text),
-                line.end(),
-            ).start()
+            lines, ends = self.get_batch(line, line_text)
+            self.view.add_regions("worksheet", [sublime.Region(line.begin(), ends[-1])], "string")
+            interval = self.repl.checkpoint_interval
+            checkpoint = interval and self.line_number % interval == 0 and \
+                self.line_number > 0 and line_text[:1] not in " \t\n"
+            shifted = self.shifted
+            callback = self.on_main_thread(
+                lambda job: self.handle_finished_job(job, ends, shifted))
+            if len(lines) == 1:
+                self.set_status("Sending 1 line to %(language)s REPL.")
+                job = repl.ReplJob(self.repl, line_text, checkpoint,
+                                   self.get_ahead(line), callback)
+            else:
+                self.set_status("Sending %d lines to %%(language)s REPL." % len(lines))
+                job = repl.ReplBatchJob(self.repl, lines, checkpoint, callback=callback)
+            get_worker(self.view).submit(job)
+            self.track(job, "Waiting for %(language)s REPL")
         else:
             self.cleanup()
 
-    def queue_thread(self, thread, start):
-        sublime.set_timeout(lambda: self.handle_thread(thread, start), 5)
-        return thread
+    def get_batch(self, line, line_text):
+        """The lines to send together starting with line, and where they end.
+        Batches need the REPL's sentinel, and stop before a line where a
+        checkpoint is due."""
+        lines, ends = [line_text], [line.end()]
+        size = self.repl.batch_size if self.repl.sentinel and self.repl.at_first_prompt else 1
+        if self.repl.in_flight:
+            size = 1
+        interval = self.repl.checkpoint_interval
+        python = self.get_language() == "Python"
+        next_text = self.view.substr(self.view.full_line(line.end()))
+        if not batchable(line_text, next_text, python):
+            return lines, ends
+        while len(lines) < size and "\n" in next_text:
+            if interval and (self.line_number + len(lines)) % interval == 0:
+                break
+            region = self.view.full_line(ends[-1])
+            after = self.view.substr(self.view.full_line(region.end()))
+            if not batchable(next_text, after, python):
+                break
+            lines.append(next_text)
+            ends.append(region.end())
+            next_text = after
+        return lines, ends
 
-    def handle_thread(self, thread, next_start):
-        if thread.is_alive():
-            self.handle_running_thread(thread, next_start)
-        else:
-            self.handle_finished_thread(thread, next_start)
+    def get_ahead(self, line):
+        """The lines after line that may be sent to the REPL before line's
+        result is in, up to one before the next checkpoint."""
+        ahead = []
+        end = line.end()
+        interval = self.repl.checkpoint_interval
+        while len(ahead) < self.repl.pipeline - 1:
+            if interval and (self.line_number + 1 + len(ahead)) % interval == 0:
+                break
+            region = self.view.full_line(end)
+            text = self.view.substr(region)
+            if "\n" not in text:
+                break
+            ahead.append(text)
+            end = region.end()
+        return ahead
 
-    def handle_running_thread(self, thread, next_start):
-        self.set_status("Waiting for %(language)s REPL.")
-        self.queue_thread(thread, next_start)
-
-    def handle_finished_thread(self, thread, next_start):
+    def handle_finished_job(self, job, ends, shifted):
+        self.running = None
         self.view.add_regions("worksheet", list(), "string")
-        result = thread.result
-        self.insert(result, next_start)
-        next_start += len(str(result))
+        if job.checkpoint:
+            self.history.add_checkpoint(self.line_number, job.checkpoint)
+        # Results flushed since the job was sent have moved its lines down.
+        moved = self.shifted - shifted
+        for result, end in zip(job.results, ends):
+            self.insert(result, end + moved)
+            self.remember(result)
+            self.line_number += 1
         if not result.terminates:
-            self.process_line(next_start)
+            self.process_line(end + moved)
         else:
             self.cleanup()
 
+    def remember(self, result):
+        self.history.add(self.line_number, result)
+        # A line that timed out or ran into a limit may not next time.
+        cacheable = not (result.is_timeout or result.is_eof or result.is_limit)
+        if self.cache is not None and cacheable and self.line_number < len(self.hashes):
+            self.cache.put(self.hashes[self.line_number], result)
+
     def insert(self, text, start):
+        """Queue text to go in at start, which is where it would go if the
+        results queued before it weren't in the view yet either."""
+        self.results += 1
+        if str(text):
+            self.pending.append((start, str(text)))
+        if not self.flush_queued:
+            self.flush_queued = True
+            sublime.set_timeout(self.flush, self.flush_interval)
+
+    def flush(self):
+        self.flush_queued = False
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        if self.use_phantoms:
+            # Each result goes below the line that ends where it would go.
+            phantoms = view_phantoms.get(self.view.id())
+            if phantoms is None:
+                phantoms = view_phantoms[self.view.id()] = ResultPhantoms(self.view, self.prefix)
+            phantoms.add([(self.view.line(start - 1), text) for start, text in pending])
+            return
         with Edit(self.view) as edit:
-            edit.insert(start, str(text))
+            # From the end, so each insert leaves the points before it be.
+            for start, text in reversed(pending):
+                edit.insert(start, text)
+        regions = self.view.get_regions("worksheet_results")
+        shift = 0
+        for start, text in pending:
+            # Leaving out the last newline, so that text typed after the
+            # result, e.g. at the end of the view, doesn't join it.
+            regions.append(sublime.Region(start + shift, start + shift + len(text) - 1))
+            shift += len(text)
+        self.view.add_regions("worksheet_results", regions, "", "", sublime.HIDDEN)
+        self.shifted += sum(len(text) for start, text in pending)
+        self.flushes += 1
 
     def set_status(self, msg, key="worksheet"):
         self.view.set_status(key, msg % {"language": self.get_language()})
 
+    def report_stats(self):
+        stats = self.repl.stats()
+        report = []
+        if stats["uses"] == 1 and stats["startup"] is not None:
+            report.append("REPL started in %.2fs" % stats["startup"])
+        if stats["uses"] > 1:
+            report.append("REPL reused %d times" % (stats["uses"] - 1))
+        if stats["send_delay_saved"]:
+            report.append("skipped %.1fs of send delay" % stats["send_delay_saved"])
+        if stats["closing"]:
+            report.append("%d REPLs closing" % stats["closing"])
+        if stats["reads"]:
+            report.append("%d reads, %d bytes/read" % (
+                stats["reads"], stats["bytes_read"] // stats["reads"]))
+        if self.flushes:
+            report.append("%d results in %d edits" % (self.results, self.flushes))
+        if report:
+            self.set_status("Worksheet: " + ", ".join(report), "worksheet_stats")
+
+    def finish_results(self):
+        self.flush()
+        self.view.run_command("glue_marked_undo_groups")
+        if self.cache is not None:
+            self.cache.flush()
+
     def cleanup(self):
+        self.finish_results()
         self.set_status('')
+        self.report_stats()
         try:
-            self.repl.close()
+            repl.pool.release(self.repl)
         except repl.ReplCloseError as e:
             sublime.error_message(
                 "Could not close the REPL:\n" + str(e))
+        self.history.keep(self.repl)
 
 
 class WorksheetEvalCommand(WorksheetCommand):
-    def run(self, edit):
-        WorksheetCommand.run(self, edit)
-        self.ensure_trailing_newline(edit)
-        self.process_line(0)
+    def started(self):
+        self.ensure_trailing_newline()
+        self.process_line(self.start)
+
+    def resume_point(self, repl_def):
+        self.history = view_histories.setdefault(self.view.id(), History())
+        source = self.source
+        line, resume = self.history.resume_point(
+            self.hashes, [text for offset, text in source], self.shown_lines())
+        self.line_number = line
+        if resume is None or line >= len(source):
+            self.line_number = 0
+            return 0, None
+        return source[line][0], resume
+
+    def shown_lines(self):
+        """How many of the lines evaluated last time still have all their
+        results, and only those, in the view before them; undoing or
+        erasing results means evaluating those lines again."""
+        if self.use_phantoms:
+            phantoms = view_phantoms.get(self.view.id())
+            regions = phantoms.regions() if phantoms is not None else []
+        elif self.view.id() in tracked_views:
+            regions = self.view.get_regions("worksheet_results")
+        else:
+            return 0
+        starts = sorted(region.begin() for region in regions if region.size())
+        lines = self.history.lines
+        shown = expected = 0
+        for n in range(len(lines) + 1):
+            offset = self.source[n][0] if n < len(self.source) else self.view.size() + 1
+            while shown < len(starts) and starts[shown] < offset:
+                shown += 1
+            if shown != expected:
+                return max(n - 1, 0)
+            if n < len(lines) and str(lines[n][1]):
+                expected += 1
+        return len(lines)
 
 
 class WorksheetClearCommand(WorksheetCommand):
     def run(self, edit):
-        WorksheetCommand.run(self, edit)
+        # Clearing only needs the prefix, not a REPL.
+        self.load_settings()
+        language, repl_def = get_repl_def(self.view, self.settings, self.project_settings)
+        self.prefix = repl_def["prefix"]
+        cancel_start(self.view)
+        self.resume_point(repl_def)
+        self.set_status("")
+        self.set_status("", "worksheet_stats")
+        # Results written as text go too, whatever the mode.
+        self.use_phantoms = False
+        self.remove_previous_results()
+
+
+class WorksheetPrewarmListener(sublime_plugin.EventListener):
+    """Starts a standby REPL when a worksheet view is opened or focused, so
+    the first evaluation doesn't wait for the interpreter to start."""
+    def on_load(self, view):
+        self.prewarm(view)
+
+    def on_activated(self, view):
+        self.prewarm(view)
+
+    def prewarm(self, view):
+        settings = sublime.load_settings("worksheet.sublime-settings")
+        if not settings.get("worksheet_prewarm"):
+            return
+        idle_timeout = settings.get("worksheet_prewarm_idle_timeout")
+        repl.pool.expire(idle_timeout)
+        if view.settings().get("syntax") is None:
+            return
+        language, repl_def = get_repl_def(view, settings, {})
+        if language not in settings.get("worksheet_languages"):
+            return
+        try:
+            warming = repl.pool.prewarm(language, repl_def, settings.get("worksheet_prewarm_max"))
+        except repl.ReplStartError:
+            return
+        if warming:
+            sublime.set_timeout(lambda: repl.pool.expire(idle_timeout),
+                                int(idle_timeout * 1000) + 1000)
+
+
+class WorksheetHistoryListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        if view.id() in view_histories:
+            view_histories.pop(view.id()).forget()
+
+
+class WorksheetPhantomsListener(sublime_plugin.EventListener):
+    def on_activated(self, view):
+        phantoms = view_phantoms.get(view.id())
+        if phantoms is not None:
+            phantoms.render()
+            phantoms.start_polling()
+
+    def on_modified(self, view):
+        phantoms = view_phantoms.get(view.id())
+        if phantoms is not None:
+            phantoms.render()
+
+    def on_close(self, view):
+        view_phantoms.pop(view.id(), None)
+
+
+class WorksheetResultsListener(sublime_plugin.EventListener):
+    """Stops going by a view's result regions, and forgets its History,
+    once undoing, redoing or reverting may have brought back results they
+    don't cover or taken away results the History has."""
+    def on_post_text_command(self, view, command_name, args):
+        if command_name in ("undo", "soft_undo", "redo", "redo_or_repeat", "soft_redo", "revert"):
+            tracked_views.discard(view.id())
+            if view.id() in view_histories:
+                view_histories[view.id()].forget()
+
+    def on_close(self, view):
+        tracked_views.discard(view.id())
+
+
+class WorksheetStartListener(sublime_plugin.EventListener):
+    """Cancels starting a REPL for a view that is edited or closed before
+    the REPL is up; the evaluation would be of stale text."""
+    def on_modified(self, view):
+        thread, change_count = view_starts.get(view.id(), (None, None))
+        if thread is not None and view.change_count() != change_count:
+            cancel_start(view)
+            view.set_status("worksheet", "")
+
+    def on_close(self, view):
+        cancel_start(view)
+
+
+class WorksheetWorkerListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        stop_worker(view.id())
+
+
+def plugin_unloaded():
+    for view_id in list(view_workers):
+        stop_worker(view_id)
+    repl.pool.close_all()
+    repl.close_zygotes()
+    if result_cache is not None:
+        result_cache.close()